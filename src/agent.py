@@ -0,0 +1,776 @@
+from collections import deque
+from itertools import islice
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+from .event_queue import PendingQueue, WorkItem
+from .file_handler import (DEFAULT_MTIME_TOLERANCE, HASH_BLOCK_SIZE, ZERO_BLOCK, data_extents,
+                           get_file_hash, is_deleted_backup, is_file_in_use, safe_delete,
+                           stat_identical)
+from .merkle import MerkleTree, index_path
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+AGENT_SCHEME = "agent://"
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 7733
+TOKEN_ENV = "LOCALSYNC_AGENT_TOKEN"
+
+# Frames are a JSON header and an optional binary payload, prefixed by
+# both lengths
+FRAME_PREFIX = struct.Struct('>II')
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+MAX_PAYLOAD_BYTES = 64 * 1024 * 1024
+# Until a client authenticated it may only send a small hello, and only
+# for so long
+HELLO_HEADER_BYTES = 4096
+AUTH_TIMEOUT = 10.0
+MAX_CONNECTIONS = 32
+
+# Files up to this size travel whole, many per frame; larger ones are
+# streamed block by block
+SMALL_FILE_LIMIT = HASH_BLOCK_SIZE
+BATCH_FILES = 256
+BATCH_BYTES = 8 * 1024 * 1024
+STAT_BATCH = 1024
+# Bytes of file content the agent may have to hash for one request
+HASH_BATCH_BYTES = 1024 * 1024 * 1024
+# Requests awaiting a reply before the client stops to read one
+PIPELINE_WINDOW = 8
+CONNECT_TIMEOUT = 10.0
+IO_TIMEOUT = 120.0
+# Replies that need the agent to hash files get this much longer per byte
+MIN_HASH_RATE = 16 * 1024 * 1024
+MAX_RETRY_DELAY = 60.0
+
+def is_agent_url(path: Any) -> bool:
+    return isinstance(path, str) and path.startswith(AGENT_SCHEME)
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """Return ``("tcp", (host, port))`` or ``("unix", path)`` for an agent address.
+
+    Accepts ``agent://host:port`` and ``agent:///path/to.sock`` URLs as well
+    as bare ``host:port`` and socket paths.
+    """
+    if is_agent_url(address):
+        parts = urlsplit(address)
+        if parts.hostname:
+            return "tcp", (parts.hostname, parts.port or DEFAULT_PORT)
+        if not parts.path:
+            raise ValueError(f"Agent URL without host or socket path: {address}")
+        return "unix", parts.path
+
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "unix", address
+
+def _recv_exact(sock: socket.socket, size: int) -> bytearray:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        count = sock.recv_into(view[pos:])
+        if not count:
+            raise ConnectionError("Connection closed by peer")
+        pos += count
+    return buf
+
+def send_frame(sock: socket.socket, header: Dict[str, Any], payload: bytes = b'') -> None:
+    data = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    prefix = FRAME_PREFIX.pack(len(data), len(payload))
+    if len(payload) < 65536:
+        sock.sendall(prefix + data + payload)
+    else:
+        sock.sendall(prefix + data)
+        sock.sendall(payload)
+
+def recv_frame(sock: socket.socket, max_header: int = MAX_HEADER_BYTES,
+               max_payload: int = MAX_PAYLOAD_BYTES) -> Optional[Tuple[Dict[str, Any], bytearray]]:
+    """Read one frame, or return None when the peer closed between frames."""
+    first = sock.recv(FRAME_PREFIX.size)
+    if not first:
+        return None
+    prefix = first + _recv_exact(sock, FRAME_PREFIX.size - len(first))
+    header_size, payload_size = FRAME_PREFIX.unpack(prefix)
+    if header_size > max_header or payload_size > max_payload:
+        raise ConnectionError(f"Oversized frame ({header_size}+{payload_size} bytes)")
+    header = json.loads(_recv_exact(sock, header_size))
+    if not isinstance(header, dict):
+        raise ValueError("Frame header is not an object")
+    return header, _recv_exact(sock, payload_size)
+
+TEMP_SUFFIX = ".localsync-tmp"
+
+def _temp_path(target: Path) -> Path:
+    return target.with_name(f".{target.name}.{os.getpid()}-{threading.get_ident()}{TEMP_SUFFIX}")
+
+class _Session:
+    """Requests of one client connection, handled in order."""
+
+    def __init__(self, agent: "AgentServer", sock: socket.socket):
+        self.agent = agent
+        self.sock = sock
+        self.authenticated = agent.token is None
+        # Streamed uploads in progress: path -> [file, temp path, error]
+        self.uploads: Dict[str, List[Any]] = {}
+
+    def run(self) -> None:
+        try:
+            while True:
+                if self.authenticated:
+                    self.sock.settimeout(None)
+                    frame = recv_frame(self.sock)
+                else:
+                    self.sock.settimeout(AUTH_TIMEOUT)
+                    frame = recv_frame(self.sock, HELLO_HEADER_BYTES, 0)
+                if frame is None:
+                    return
+                header, payload = frame
+                reply = self.handle(header, payload)
+                if reply is not None:
+                    reply['id'] = header.get('id')
+                    send_frame(self.sock, reply)
+                    if not self.authenticated:
+                        return
+        finally:
+            for f, temp, _ in self.uploads.values():
+                if f is not None:
+                    f.close()
+                    temp.unlink(missing_ok=True)
+
+    def handle(self, header: Dict[str, Any], payload: bytearray) -> Optional[Dict[str, Any]]:
+        op = header.get('op')
+        if op == 'hello':
+            token = header.get('token')
+            if not isinstance(token, str):
+                token = ''
+            self.authenticated = self.agent.token is None or \
+                hmac.compare_digest(token.encode(), self.agent.token.encode())
+            if not self.authenticated:
+                return {'ok': False, 'error': "Invalid token"}
+            return {'ok': True, 'version': PROTOCOL_VERSION}
+        if not self.authenticated:
+            return {'ok': False, 'error': "Not authenticated"}
+
+        handler = getattr(self, f"op_{op}", None)
+        if handler is None:
+            return {'ok': False, 'error': f"Unknown operation: {op}"}
+        try:
+            return handler(header, payload)
+        except (OSError, ValueError, KeyError) as e:
+            return {'ok': False, 'error': str(e)}
+
+    def op_stat(self, header, payload):
+        stats = []
+        for rel in header['paths']:
+            path = self.agent.resolve(rel)
+            try:
+                st = path.stat()
+            except OSError:
+                stats.append(None)
+                continue
+            stats.append({'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                          'hash': self.agent.index.file_hash(rel) if header.get('hash') else ''})
+        return {'ok': True, 'stats': stats}
+
+    def op_list(self, header, payload):
+        listings = []
+        for rel in header['paths']:
+            path = self.agent.resolve(rel) if rel else self.agent.root
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                listings.append(None)
+                continue
+            dirs, files = [], []
+            for entry in entries:
+                if is_deleted_backup(entry.name) or entry.name.endswith(TEMP_SUFFIX):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry.name)
+                except OSError:
+                    pass
+            listings.append([dirs, files])
+        return {'ok': True, 'listings': listings}
+
+    def op_put(self, header, payload):
+        failed = {}
+        view = memoryview(payload)
+        offset = 0
+        for rel, size, mtime_ns, mode, md5 in header['files']:
+            data = view[offset:offset + size]
+            offset += size
+            temp = None
+            try:
+                if hashlib.md5(data).hexdigest() != md5:
+                    raise ValueError("Checksum mismatch")
+                target = self.agent.resolve(rel)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                temp = _temp_path(target)
+                with open(temp, 'wb') as f:
+                    f.write(data)
+                self.agent.commit(temp, target, mtime_ns, mode)
+            except (OSError, ValueError) as e:
+                if temp is not None:
+                    temp.unlink(missing_ok=True)
+                failed[rel] = str(e)
+        return {'ok': True, 'failed': failed}
+
+    def op_put_begin(self, header, payload):
+        rel = header['path']
+        try:
+            target = self.agent.resolve(rel)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            temp = _temp_path(target)
+            self.uploads[rel] = [open(temp, 'wb'), temp, None]
+        except (OSError, ValueError) as e:
+            self.uploads[rel] = [None, None, str(e)]
+        return None
+
+    def op_put_chunk(self, header, payload):
+        upload = self.uploads.get(header['path'])
+        if upload is None or upload[2]:
+            return None
+        try:
+            upload[0].seek(header['offset'])
+            upload[0].write(payload)
+        except OSError as e:
+            upload[2] = str(e)
+        return None
+
+    def op_put_end(self, header, payload):
+        rel = header['path']
+        upload = self.uploads.pop(rel, None)
+        if upload is None:
+            return {'ok': True, 'failed': {rel: "Upload was never started"}}
+        f, temp, error = upload
+        if header.get('abort'):
+            if f is not None:
+                f.close()
+                temp.unlink(missing_ok=True)
+            return {'ok': True, 'failed': {}}
+        try:
+            if error:
+                raise OSError(error)
+            # Zero blocks were never sent, truncating leaves them as holes
+            f.truncate(header['size'])
+            f.close()
+            if get_file_hash(temp) != header['hash']:
+                raise ValueError("Checksum mismatch")
+            self.agent.commit(temp, self.agent.resolve(rel), header['mtime_ns'], header['mode'])
+        except (OSError, ValueError) as e:
+            if f is not None:
+                f.close()
+                temp.unlink(missing_ok=True)
+            return {'ok': True, 'failed': {rel: str(e)}}
+        return {'ok': True, 'failed': {}}
+
+    def op_delete(self, header, payload):
+        failed = {}
+        for rel in header['paths']:
+            try:
+                path = self.agent.resolve(rel)
+                if path.is_file() and is_file_in_use(path):
+                    raise OSError("File is being edited")
+                safe_delete(path)
+                self.agent.index.update(rel)
+            except (OSError, ValueError) as e:
+                failed[rel] = str(e)
+        return {'ok': True, 'failed': failed}
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            _Session(self.server.agent, self.request).run()
+        except Exception as e:
+            logger.warning(f"Agent connection {self.client_address or 'unix'} failed: {str(e)}")
+
+class _Limited:
+    """Refuse connections beyond MAX_CONNECTIONS instead of starting threads for them."""
+
+    slots = None
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            logger.warning(f"Agent refused {client_address or 'unix'}: too many connections")
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+class _TCPServer(_Limited, socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(_Limited, socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+class AgentServer:
+    """Serve a replica folder to RemoteReplica clients over TCP or a unix socket.
+
+    Each connection gets a thread of its own. Files are written to a
+    temporary name and renamed into place once their checksum matched, and
+    deletions keep the usual timestamped backup. Without a ``token`` any
+    client may connect, so bind to loopback or a unix socket then. Until a
+    client authenticated only a small hello is read from it, and at most
+    MAX_CONNECTIONS clients are served at once.
+
+    Hashes asked for by clients come from a Merkle index of the replica,
+    so once build_index ran only files that changed are read again.
+    """
+
+    def __init__(self, root: Path, address: str, token: Optional[str] = None):
+        self.root = Path(root).resolve()
+        self.token = str(token) if token is not None else None
+        self.index = MerkleTree(self.root)
+        self.family, bind = parse_address(address)
+        if self.family == "unix":
+            if os.path.exists(bind):
+                os.unlink(bind)
+            self._server = _UnixServer(bind, _Handler)
+        else:
+            self._server = _TCPServer(bind, _Handler)
+        self._server.agent = self
+        self._server.slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+    @property
+    def address(self) -> str:
+        """Agent URL clients can connect to."""
+        if self.family == "unix":
+            return f"{AGENT_SCHEME}{self._server.server_address}"
+        host, port = self._server.server_address[:2]
+        return f"{AGENT_SCHEME}{host}:{port}"
+
+    def resolve(self, rel: str) -> Path:
+        """Map a replica-relative path onto the root, refusing paths outside it."""
+        parts = PurePosixPath(rel)
+        if parts.is_absolute() or '..' in parts.parts or not parts.parts:
+            raise ValueError(f"Invalid replica path: {rel}")
+        return self.root.joinpath(*parts.parts)
+
+    def commit(self, temp: Path, target: Path, mtime_ns: int, mode: int) -> None:
+        os.chmod(temp, mode)
+        os.utime(temp, ns=(mtime_ns, mtime_ns))
+        os.replace(temp, target)
+        self.index.update(target.relative_to(self.root))
+        logger.info(f"Received: {target}")
+
+    def build_index(self) -> None:
+        """Build the replica index from its persisted copy and save it back."""
+        self.index.build(MerkleTree.load_cache(index_path(self.root)))
+        logger.info(f"Agent index ready for {self.root}")
+        self.save_index()
+
+    def save_index(self) -> None:
+        if not self.index.ready:
+            return
+        try:
+            self.index.save(index_path(self.root))
+        except OSError as e:
+            logger.warning(f"Failed to save index for {self.root}: {str(e)}")
+
+    def serve_forever(self) -> None:
+        logger.info(f"Agent serving {self.root} on {self.address}")
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self.family == "unix":
+            try:
+                os.unlink(self._server.server_address)
+            except OSError:
+                pass
+
+def _walk_files(subtree: Path) -> Iterator[Path]:
+    if subtree.is_file():
+        yield subtree
+        return
+    for dirpath, dirnames, filenames in os.walk(subtree):
+        for filename in filenames:
+            if not is_deleted_backup(filename):
+                yield Path(dirpath) / filename
+
+class RemoteReplica:
+    """Mirror a group's source folders onto a replica agent.
+
+    Work is queued on a PendingQueue of its own and sent in batches by a
+    background thread. One stat request covers a whole batch, asking for
+    hashes only where the compare strategy needs them; small files travel
+    many to a frame, large ones are streamed without their holes and
+    verified by the agent before they replace the old copy. Requests are
+    pipelined, up to PIPELINE_WINDOW waiting for a reply at a time.
+
+    The agent is a mirror: its copy never wins, and rescans list it to
+    delete what no source folder has any more. Local hashes come from the
+    sources' Merkle ``trees`` when given, which are waited for before the
+    first batch.
+    """
+
+    def __init__(self, url: str, sources: List[Path], strategy: str = "paranoid",
+                 mtime_tolerance: float = DEFAULT_MTIME_TOLERANCE,
+                 token: Optional[str] = None, name: str = "",
+                 trees: Optional[Dict[Path, MerkleTree]] = None):
+        self.url = url
+        self.strategy = strategy
+        self.mtime_tolerance = mtime_tolerance
+        # Tokens from YAML may well be numbers
+        self.token = str(token) if token is not None else None
+        self.trees = trees or {}
+        self.queue = PendingQueue(sources, name=f"{name}->{url}", watched=False)
+        self.failed: Dict[str, str] = {}
+        self._sock: Optional[socket.socket] = None
+        self._next_id = 0
+        self._inflight: deque = deque()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def put(self, src_root: Path, src_path: Path, operation: str) -> None:
+        self.queue.put(src_root, src_path, operation)
+
+    def mark_dirty(self, src_root: Path, subtree: Optional[Path] = None) -> None:
+        self.queue.mark_dirty(src_root, subtree)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stopped.set()
+        self.queue.close()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._disconnect()
+
+    def _run(self) -> None:
+        # Comparing before the indexes are built would hash every file
+        while not all(tree.ready for tree in self.trees.values()):
+            if self._stopped.wait(1):
+                return
+
+        retries = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < BATCH_FILES:
+                item = self.queue.get(timeout=0)
+                if item is None:
+                    break
+                batch.append(item)
+
+            try:
+                with tracer.profile():
+                    self.sync_batch(batch)
+                retries = 0
+            except Exception as e:
+                logger.error(f"Failed to sync to {self.url}: {str(e)}")
+                self._disconnect()
+                # Retry the whole batch once the agent is back, unless
+                # newer events for the same paths came in meanwhile
+                for kind, src_root, path, operation in batch:
+                    if kind == "rescan":
+                        self.queue.mark_dirty(src_root, path)
+                    else:
+                        self.queue.put(src_root, path, operation, replace=False)
+                if self._stopped.wait(min(2 ** retries, MAX_RETRY_DELAY)):
+                    break
+                retries += 1
+
+    def sync_batch(self, items: List[WorkItem]) -> None:
+        """Push a batch of queued work items to the agent."""
+        entries = self._expand(items)
+        while True:
+            chunk = list(islice(entries, STAT_BATCH))
+            if not chunk:
+                break
+            with tracer.span("remote_batch", url=self.url, files=len(chunk)):
+                self._sync_chunk(chunk)
+
+    def _expand(self, items: List[WorkItem]) -> Iterator[Tuple[str, Path, str]]:
+        for kind, src_root, path, operation in items:
+            if kind == "rescan":
+                for file_path in _walk_files(path):
+                    yield file_path.relative_to(src_root).as_posix(), src_root, "modified"
+                yield from self._stale(src_root, path)
+            else:
+                yield path.relative_to(src_root).as_posix(), src_root, operation
+
+    def _stale(self, src_root: Path, subtree: Path) -> Iterator[Tuple[str, Path, str]]:
+        """Deletions for the paths on the agent below ``subtree`` that no source has."""
+        rel = subtree.relative_to(src_root).as_posix()
+        pending = ['' if rel == '.' else rel]
+        while pending:
+            dirs = pending[:STAT_BATCH]
+            del pending[:STAT_BATCH]
+            with tracer.span("remote_list", dirs=len(dirs)):
+                listings = self._call({'op': 'list', 'paths': dirs})['listings']
+            for rel_dir, listing in zip(dirs, listings):
+                if listing is None:
+                    continue
+                subdirs, files = listing
+                for name in subdirs + files:
+                    rel = f"{rel_dir}/{name}" if rel_dir else name
+                    if not any((root / rel).exists() for root in self.queue.roots):
+                        yield rel, src_root, "deleted"
+                    elif name in subdirs:
+                        pending.append(rel)
+
+    def _sync_chunk(self, chunk: List[Tuple[str, Path, str]]) -> None:
+        deletes = []
+        local = {}
+        for rel, src_root, operation in dict((entry[0], entry) for entry in chunk).values():
+            path = src_root / rel
+            try:
+                stat = path.stat()
+            except OSError:
+                if operation == "deleted":
+                    deletes.append(rel)
+                continue
+            if not path.is_file():
+                continue
+            if is_file_in_use(path):
+                logger.info(f"Skipping sync as source file is being edited: {path}")
+                continue
+            local[rel] = (src_root, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+        send = []
+        ambiguous = []
+        if local:
+            # A mirror's own copy never wins, so only the content is compared
+            remote = self._stat(list(local))
+            for rel, (path, info) in local.items():
+                identical = stat_identical(info, remote[rel], self.strategy, self.mtime_tolerance) \
+                    if remote[rel] else False
+                if identical is None:
+                    ambiguous.append(rel)
+                elif not identical:
+                    send.append(rel)
+            # Hash requests are capped by the bytes the agent has to read
+            group, size = [], 0
+            for rel in ambiguous:
+                group.append(rel)
+                size += local[rel][1]['size']
+                if size >= HASH_BATCH_BYTES or rel == ambiguous[-1]:
+                    hashes = self._stat(group, with_hash=True, work=size)
+                    send += [rel for rel in group
+                             if not hashes[rel] or self._hash(rel, local[rel][0]) != hashes[rel]['hash']]
+                    group, size = [], 0
+
+        self._send_files([(rel, local[rel][0] / rel) for rel in send])
+        if deletes:
+            self._request({'op': 'delete', 'paths': deletes})
+        self._drain()
+
+        failed, self.failed = self.failed, {}
+        for rel, error in failed.items():
+            logger.error(f"Agent {self.url} failed on {rel}: {error}")
+        for rel in send:
+            if rel not in failed:
+                logger.info(f"Synchronized: {self.url}/{rel}")
+        for rel in deletes:
+            if rel not in failed:
+                logger.info(f"Deleted: {self.url}/{rel}")
+
+    def _stat(self, paths: List[str], with_hash: bool = False,
+              work: int = 0) -> Dict[str, Optional[dict]]:
+        with tracer.span("remote_stat", files=len(paths), hash=with_hash):
+            reply = self._call({'op': 'stat', 'paths': paths, 'hash': with_hash}, work)
+        return dict(zip(paths, reply['stats']))
+
+    def _hash(self, rel: str, src_root: Path) -> str:
+        tree = self.trees.get(src_root)
+        return tree.file_hash(rel) if tree is not None else get_file_hash(src_root / rel)
+
+    def _send_files(self, files: List[Tuple[str, Path]]) -> None:
+        batch = []
+        payload = bytearray()
+        for rel, path in files:
+            # Only local file errors are handled here; transport errors
+            # reach _run, which reconnects and retries
+            try:
+                f = open(path, 'rb', buffering=0)
+            except OSError as e:
+                self.failed[rel] = str(e)
+                continue
+            with f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > SMALL_FILE_LIMIT:
+                    self._stream(rel, f, stat)
+                    continue
+                try:
+                    data = f.read()
+                except OSError as e:
+                    self.failed[rel] = str(e)
+                    continue
+            batch.append([rel, len(data), stat.st_mtime_ns, stat.st_mode & 0o7777,
+                          hashlib.md5(data).hexdigest()])
+            payload += data
+            if len(batch) >= BATCH_FILES or len(payload) >= BATCH_BYTES:
+                self._request({'op': 'put', 'files': batch}, payload)
+                batch, payload = [], bytearray()
+        if batch:
+            self._request({'op': 'put', 'files': batch}, payload)
+
+    def _stream(self, rel: str, f, stat: os.stat_result) -> None:
+        """Send a large file block by block, hashing it as get_file_hash does.
+
+        A local read error aborts the upload on the agent and is recorded
+        as a failure of the file.
+        """
+        with tracer.span("remote_stream", path=rel, size=stat.st_size):
+            try:
+                extents = list(data_extents(f.fileno(), stat.st_size))
+            except OSError as e:
+                self.failed[rel] = str(e)
+                return
+
+            self._request({'op': 'put_begin', 'path': rel}, reply=False)
+            md5 = hashlib.md5(stat.st_size.to_bytes(8, 'little'))
+            next_offset = 0
+            error = None
+            for start, end in extents:
+                offset = max(start - start % HASH_BLOCK_SIZE, next_offset)
+                while offset < end:
+                    try:
+                        f.seek(offset)
+                        block = f.read(HASH_BLOCK_SIZE)
+                    except OSError as e:
+                        error = e
+                        break
+                    if not block:
+                        break
+                    if block != ZERO_BLOCK[:len(block)]:
+                        md5.update(offset.to_bytes(8, 'little'))
+                        md5.update(block)
+                        self._request({'op': 'put_chunk', 'path': rel, 'offset': offset},
+                                      block, reply=False)
+                    offset += len(block)
+                if error is not None:
+                    break
+                next_offset = offset
+
+            self._request({'op': 'put_end', 'path': rel, 'size': stat.st_size,
+                           'mtime_ns': stat.st_mtime_ns, 'mode': stat.st_mode & 0o7777,
+                           'hash': md5.hexdigest(), 'abort': error is not None},
+                          work=stat.st_size)
+            if error is not None:
+                self.failed[rel] = str(error)
+
+    def _connect(self) -> socket.socket:
+        if self._sock is not None:
+            return self._sock
+        family, address = parse_address(self.url)
+        if family == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(address, CONNECT_TIMEOUT)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(IO_TIMEOUT)
+        self._sock = sock
+        self._call({'op': 'hello', 'version': PROTOCOL_VERSION, 'token': self.token})
+        logger.info(f"Connected to agent {self.url}")
+        return sock
+
+    def _disconnect(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._inflight.clear()
+        self.failed.clear()
+
+    def _request(self, header: Dict[str, Any], payload: bytes = b'', reply: bool = True,
+                 work: int = 0) -> int:
+        """Send a request without waiting for its reply, unless the window is full.
+
+        ``work`` is the number of bytes the agent has to hash before it can
+        reply, which extends the time the reply is waited for.
+        """
+        sock = self._connect()
+        request_id = header['id'] = self._next_id
+        self._next_id += 1
+        send_frame(sock, header, payload)
+        if reply:
+            self._inflight.append((request_id, work))
+            while len(self._inflight) > PIPELINE_WINDOW:
+                self._read_reply()
+        return request_id
+
+    def _read_reply(self) -> Dict[str, Any]:
+        request_id, work = self._inflight[0]
+        self._sock.settimeout(IO_TIMEOUT + work / MIN_HASH_RATE)
+        frame = recv_frame(self._sock)
+        if frame is None:
+            raise ConnectionError(f"Agent {self.url} closed the connection")
+        reply = frame[0]
+        self._inflight.popleft()
+        if reply.get('id') != request_id:
+            raise ConnectionError(f"Agent {self.url} replied out of order")
+        if not reply.get('ok'):
+            raise RuntimeError(f"Agent {self.url}: {reply.get('error')}")
+        self.failed.update(reply.get('failed', {}))
+        return reply
+
+    def _call(self, header: Dict[str, Any], work: int = 0) -> Dict[str, Any]:
+        """Send a request and wait for its reply."""
+        request_id = self._request(header, work=work)
+        while True:
+            reply = self._read_reply()
+            if reply['id'] == request_id:
+                return reply
+
+    def _drain(self) -> None:
+        while self._inflight:
+            self._read_reply()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a folder as a localsync replica")
+    parser.add_argument("--root", required=True, help="folder to receive the replica")
+    parser.add_argument("--listen", default=f"127.0.0.1:{DEFAULT_PORT}",
+                        help="host:port or unix socket path")
+    parser.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                        help=f"shared secret clients must present (default: ${TOKEN_ENV})")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    root = Path(args.root)
+    root.mkdir(parents=True, exist_ok=True)
+    server = AgentServer(root, args.listen, args.token)
+    threading.Thread(target=server.build_index, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.save_index()
+
+if __name__ == "__main__":
+    main()
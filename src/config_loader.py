@@ -1,12 +1,86 @@
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, Dict, List, Optional, Tuple
 import yaml
 import logging
+from .agent import is_agent_url
+from .file_handler import COMPARE_STRATEGIES
 
 logger = logging.getLogger(__name__)
 
-def load_config(config_path: str = "config.yaml") -> Dict[str, List[Path]]:
-    """Load folder paths from configuration file."""
+WATCH_BACKENDS = ("native", "poll")
+SYNC_MODES = ("bidirectional", "source-only", "mirror-only")
+
+def parse_folder_entry(entry) -> Tuple[Path, Dict[str, Any]]:
+    """Parse a folder entry, either a plain path or a mapping with a ``path`` key."""
+    if isinstance(entry, dict):
+        options = dict(entry)
+        if "path" not in options:
+            raise ValueError(f"Folder entry without path: {entry}")
+        path = options.pop("path")
+    else:
+        path, options = entry, {}
+
+    watch = options.get("watch", "native")
+    if watch not in WATCH_BACKENDS:
+        raise ValueError(f"Unknown watch backend '{watch}' for folder {path}")
+    if options.get("mode", "bidirectional") not in SYNC_MODES:
+        raise ValueError(f"Unknown mode '{options['mode']}' for folder {path}")
+    for key in ("poll_interval", "poll_stat_budget"):
+        value = options.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                  or value <= 0):
+            raise ValueError(f"{key} must be a positive number for folder {path}")
+
+    return Path(path).resolve(), options
+
+def parse_group(entries: List, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Parse the folder list and group-level options of a single group.
+
+    ``modes`` holds each folder's effective mode: its own ``mode`` option,
+    else the group's, else bidirectional. ``agent://`` entries are not local
+    folders but replica agents, listed under ``remotes``; they are always
+    mirror-only.
+    """
+    options = dict(options or {})
+    group_mode = options.get("mode", "bidirectional")
+    if group_mode not in SYNC_MODES:
+        raise ValueError(f"Unknown group mode '{group_mode}'")
+    if options.get("compare", "paranoid") not in COMPARE_STRATEGIES:
+        raise ValueError(f"Unknown compare strategy '{options['compare']}'")
+
+    folders = []
+    folder_options = {}
+    modes = {}
+    remotes = []
+    for entry in entries:
+        url = entry.get("path") if isinstance(entry, dict) else entry
+        if is_agent_url(url):
+            remote_opts = dict(entry) if isinstance(entry, dict) else {}
+            remote_opts.pop("path", None)
+            if remote_opts.get("mode", "mirror-only") != "mirror-only":
+                raise ValueError(f"Agent replica {url} can only be mirror-only")
+            remotes.append({"url": url, "options": remote_opts})
+            continue
+
+        folder, folder_opts = parse_folder_entry(entry)
+        folders.append(folder)
+        folder_options[folder] = folder_opts
+        modes[folder] = folder_opts.get("mode", group_mode)
+
+    if (modes or remotes) and all(mode == "mirror-only" for mode in modes.values()):
+        raise ValueError("A group needs at least one folder that is not mirror-only")
+
+    return {"folders": folders, "folder_options": folder_options,
+            "modes": modes, "remotes": remotes, "options": options}
+
+def load_config(config_path: str = "config.yaml") -> Dict[str, Dict[str, Any]]:
+    """Load folder groups from configuration file.
+
+    Each group maps to ``{"folders": [Path, ...], "folder_options": {Path: {...}},
+    "modes": {Path: mode}, "remotes": [{"url": ..., "options": {...}}, ...],
+    "options": {...}}``, where ``options`` comes from the ``group_options``
+    section (the single ``folders`` group is named ``default`` there).
+    """
     try:
         with open(config_path, "r", encoding='utf-8') as f:
             config = yaml.safe_load(f)
@@ -15,23 +89,23 @@ def load_config(config_path: str = "config.yaml") -> Dict[str, List[Path]]:
             raise ValueError("Config file is empty")
             
         result = {}
+        group_options = config.get("group_options") or {}
         
         # Handle single group configuration
         if "folders" in config:
-            folders = [Path(folder).resolve() for folder in config["folders"]]
-            result["default"] = folders
+            result["default"] = parse_group(config["folders"], group_options.get("default"))
             
         # Handle multiple groups configuration
         if "folder_groups" in config:
             for group_name, folders in config["folder_groups"].items():
-                result[group_name] = [Path(folder).resolve() for folder in folders]
+                result[group_name] = parse_group(folders, group_options.get(group_name))
                 
         if not result:
             raise ValueError("No valid folder configuration found")
             
         # Validate all folders
-        for group_folders in result.values():
-            for folder in group_folders:
+        for group in result.values():
+            for folder in group["folders"]:
                 if not folder.exists():
                     folder.mkdir(parents=True, exist_ok=True)
                     logger.info(f"Created folder: {folder}")
@@ -0,0 +1,211 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_EVENTS = 10000
+MAX_PENDING_BYTES = 8 * 1024 * 1024
+MAX_DIRTY_SUBTREES = 1000
+# Rough per-entry cost of the key tuple, the Path objects and the dict slot
+EVENT_OVERHEAD_BYTES = 400
+
+WorkItem = Tuple[str, Path, Path, str]
+
+_queues: "weakref.WeakSet[PendingQueue]" = weakref.WeakSet()
+# Queues are created on the event loop while the heartbeat thread reads them
+_queues_lock = threading.Lock()
+# Root of the inotify instance whose buffer is being parsed on this thread
+_reading = threading.local()
+
+class PendingQueue:
+    """Bounded, memory-capped queue of pending sync work for one group.
+
+    Events for the same path are coalesced, keeping only the latest
+    operation. When the queue is saturated, the parent directory of the
+    incoming event is marked dirty instead, and handed out later as a
+    single rescan item that supersedes any event below it.
+
+    ``watched`` queues are fed by observers of their roots and are marked
+    dirty when one of those drops events.
+    """
+
+    def __init__(self, roots: List[Path], max_events: int = MAX_PENDING_EVENTS,
+                 max_bytes: int = MAX_PENDING_BYTES, name: str = "", watched: bool = True):
+        self.roots = list(roots)
+        self.name = name
+        self.watched = watched
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._events: "OrderedDict[Tuple[Path, Path], Tuple[str, int]]" = OrderedDict()
+        self._bytes = 0
+        self._dirty: Dict[Path, List[Path]] = {}
+        self._closed = False
+        self.stats = {'queued': 0, 'coalesced': 0, 'saturated': 0,
+                      'overflows': 0, 'rescans': 0}
+        with _queues_lock:
+            _queues.add(self)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._events)
+
+    def put(self, src_root: Path, src_path: Path, operation: str, replace: bool = True) -> None:
+        """Queue an event, falling back to a dirty subtree when saturated.
+
+        With ``replace`` false, an event already queued for the path is
+        kept, as when retrying work that may have been superseded.
+        """
+        with self._cond:
+            if self._closed or self._is_dirty(src_root, src_path):
+                return
+
+            key = (src_root, src_path)
+            if key in self._events and not replace:
+                return
+            if key in self._events:
+                # Keep the queue position, or a path that keeps changing
+                # would never reach the front
+                size = self._events[key][1]
+                self._events[key] = (operation, size)
+                self.stats['coalesced'] += 1
+                return
+
+            size = len(str(src_path)) + EVENT_OVERHEAD_BYTES
+            if len(self._events) >= self.max_events or self._bytes + size > self.max_bytes:
+                self.stats['saturated'] += 1
+                self._mark_dirty(src_root, src_path.parent)
+            else:
+                self._events[key] = (operation, size)
+                self._bytes += size
+                self.stats['queued'] += 1
+            self._cond.notify()
+
+    def mark_dirty(self, src_root: Path, subtree: Optional[Path] = None) -> None:
+        """Request a rescan of ``subtree`` (the whole root by default)."""
+        with self._cond:
+            self._mark_dirty(src_root, subtree or src_root)
+            self._cond.notify()
+
+    def _mark_dirty(self, src_root: Path, subtree: Path) -> None:
+        if src_root != subtree and src_root not in subtree.parents:
+            subtree = src_root
+        if self._is_dirty(src_root, subtree):
+            return
+
+        dirty = [path for path in self._dirty.get(src_root, [])
+                 if subtree not in path.parents]
+        dirty.append(subtree)
+        if len(dirty) > MAX_DIRTY_SUBTREES:
+            dirty = [src_root]
+        self._dirty[src_root] = dirty
+
+        # Pending events below a dirty subtree are covered by its rescan
+        for key in [key for key in self._events
+                    if key[0] == src_root and (key[1] == subtree or subtree in key[1].parents)]:
+            self._bytes -= self._events.pop(key)[1]
+        logger.info(f"Marked for rescan: {subtree}")
+
+    def _is_dirty(self, src_root: Path, path: Path) -> bool:
+        dirty = self._dirty.get(src_root)
+        if not dirty:
+            return False
+        return any(path == subtree or subtree in path.parents for subtree in dirty)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[WorkItem]:
+        """Return the next ``(kind, src_root, path, operation)`` item.
+
+        ``kind`` is ``"event"`` or ``"rescan"``. Returns None once the queue
+        is closed, or when ``timeout`` expires with nothing to do.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or self._events or self._dirty,
+                                       timeout):
+                return None
+            if self._closed:
+                return None
+
+            if self._dirty:
+                src_root = next(iter(self._dirty))
+                subtree = self._dirty[src_root].pop(0)
+                if not self._dirty[src_root]:
+                    del self._dirty[src_root]
+                self.stats['rescans'] += 1
+                return ("rescan", src_root, subtree, "modified")
+
+            (src_root, src_path), (operation, size) = self._events.popitem(last=False)
+            self._bytes -= size
+            return ("event", src_root, src_path, operation)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._events.clear()
+            self._dirty.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, int]:
+        """Current counters, for logging and health reports."""
+        with self._cond:
+            return dict(self.stats, pending=len(self._events), pending_bytes=self._bytes,
+                        dirty=sum(len(paths) for paths in self._dirty.values()))
+
+def _live_queues() -> List["PendingQueue"]:
+    with _queues_lock:
+        return list(_queues)
+
+def queue_stats() -> Dict[str, Dict[str, int]]:
+    """Counters of every live queue in this process, keyed by group name."""
+    return {queue.name: queue.snapshot() for queue in _live_queues()}
+
+def report_overflow(root: Path) -> None:
+    """Mark ``root`` dirty in the queues watching it after events were dropped."""
+    for queue in _live_queues():
+        if not queue.watched or root not in queue.roots:
+            continue
+        with queue._cond:
+            queue.stats['overflows'] += 1
+        queue.mark_dirty(root)
+
+def install_overflow_hook() -> None:
+    """Report inotify queue overflows instead of dropping them silently.
+
+    watchdog skips the IN_Q_OVERFLOW record (it carries wd -1) without any
+    callback, so the buffer parser is wrapped to notice it. Each watch has
+    an Inotify instance of its own, and ``read_events`` records which root
+    the buffer being parsed belongs to.
+    """
+    try:
+        from watchdog.observers.inotify_c import Inotify, InotifyConstants
+    except (ImportError, OSError):
+        return
+
+    parse = Inotify._parse_event_buffer
+    if getattr(parse, '_reports_overflow', False):
+        return
+    read_events = Inotify.read_events
+
+    def parse_event_buffer(event_buffer):
+        for wd, mask, cookie, name in parse(event_buffer):
+            root = getattr(_reading, 'root', None)
+            if wd == -1 and mask & InotifyConstants.IN_Q_OVERFLOW and root is not None:
+                logger.warning(f"Inotify event queue overflowed for {root}, rescanning")
+                report_overflow(root)
+            yield wd, mask, cookie, name
+
+    def read_events_of_root(self, *args, **kwargs):
+        _reading.root = Path(os.fsdecode(self.path))
+        try:
+            return read_events(self, *args, **kwargs)
+        finally:
+            _reading.root = None
+
+    parse_event_buffer._reports_overflow = True
+    Inotify._parse_event_buffer = staticmethod(parse_event_buffer)
+    Inotify.read_events = read_events_of_root
@@ -1,26 +1,119 @@
 from pathlib import Path
 import shutil
-from typing import List
+from typing import Callable, Collection, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
+from functools import partial
+import errno
 import logging
 import os
+import re
 import time
 from datetime import datetime
 import hashlib
+from .tracing import tracer
+
+if TYPE_CHECKING:
+    from .merkle import MerkleTree
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DELETED_BACKUP_PATTERN = re.compile(r"\.deleted\.at\d{14}$")
+COMPARE_STRATEGIES = ("quick", "checksum-on-ambiguity", "paranoid")
+DEFAULT_MTIME_TOLERANCE = 2.0
+HASH_BLOCK_SIZE = 1024 * 1024
+ZERO_BLOCK = bytes(HASH_BLOCK_SIZE)
+
+def data_extents(fd: int, size: int) -> Iterator[Tuple[int, int]]:
+    """Yield ``(start, end)`` ranges of a file that may hold data.
+
+    Holes of sparse files are skipped using SEEK_DATA/SEEK_HOLE; where
+    those are unavailable the whole file is one extent.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield (0, size)
+        return
+
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # Only a hole remains
+                return
+            if pos == 0:  # Not supported by this filesystem
+                yield (0, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if end <= start:
+            return
+        yield (start, end)
+        pos = end
+
+def is_sparse(stat: os.stat_result) -> bool:
+    """Check whether fewer blocks are allocated than the size needs."""
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < stat.st_size
+
 def get_file_hash(file_path: Path) -> str:
-    """Calculate file hash to compare content."""
+    """Calculate file hash to compare content.
+
+    The MD5 covers the file size and every block that is not all zeros,
+    tagged with its offset. Holes therefore never have to be read, and a
+    sparse file hashes the same as a dense copy of it.
+    """
     if not file_path.exists() or not file_path.is_file():
         return ""
     
     try:
-        with open(file_path, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
+        # Unbuffered, as data_extents moves the file offset behind its back
+        with tracer.span("get_file_hash", path=file_path), \
+                open(file_path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            size = os.fstat(fd).st_size
+            md5 = hashlib.md5(size.to_bytes(8, 'little'))
+            next_offset = 0
+            for start, end in data_extents(fd, size):
+                offset = max(start - start % HASH_BLOCK_SIZE, next_offset)
+                f.seek(offset)
+                while offset < end:
+                    block = f.read(HASH_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if block != ZERO_BLOCK[:len(block)]:
+                        md5.update(offset.to_bytes(8, 'little'))
+                        md5.update(block)
+                    offset += len(block)
+                next_offset = offset
+            return md5.hexdigest()
     except Exception:
         return ""
 
+def copy_file(src_path: Path, target_path: Path) -> None:
+    """Copy a file and its metadata, recreating the holes of sparse files."""
+    src_stat = src_path.stat()
+    if not is_sparse(src_stat):
+        shutil.copy2(src_path, target_path)
+        return
+
+    with open(src_path, 'rb', buffering=0) as fsrc, open(target_path, 'wb') as fdst:
+        for start, end in data_extents(fsrc.fileno(), src_stat.st_size):
+            offset = start
+            fsrc.seek(offset)
+            while offset < end:
+                block = fsrc.read(min(HASH_BLOCK_SIZE, end - offset))
+                if not block:
+                    break
+                # Zero blocks are left unwritten so they stay holes
+                if block != ZERO_BLOCK[:len(block)]:
+                    fdst.seek(offset)
+                    fdst.write(block)
+                offset += len(block)
+        fdst.truncate(src_stat.st_size)
+    shutil.copystat(src_path, target_path)
+    logger.info(f"Sparse copy: {target_path} ({src_stat.st_blocks * 512} of {src_stat.st_size} bytes allocated)")
+
 def is_file_in_use(file_path: Path) -> bool:
     """Check if a file is currently being used/edited."""
     if not file_path.exists():
@@ -47,44 +140,106 @@ def is_file_in_use(file_path: Path) -> bool:
     except (IOError, PermissionError):
         return True
 
-def get_file_info(path: Path) -> dict:
+def get_file_info(path: Path, with_hash: bool = True) -> dict:
     """Get file information including modification time, size and hash."""
-    if not path.exists():
-        return {'mtime': datetime.min, 'size': 0, 'hash': ''}
+    try:
+        stat = path.stat()
+    except OSError:
+        return {'exists': False, 'mtime_ns': -1, 'size': -1, 'hash': ''}
     
-    stat = path.stat()
     return {
-        'mtime': datetime.fromtimestamp(stat.st_mtime),
+        'exists': True,
+        'mtime_ns': stat.st_mtime_ns,
         'size': stat.st_size,
-        'hash': get_file_hash(path)
+        'hash': get_file_hash(path) if with_hash else ''
     }
 
-def should_sync_files(src_path: Path, target_path: Path) -> bool:
-    """Determine if files should be synchronized based on content and timestamps."""
+def stat_identical(
+    src_info: dict,
+    target_info: dict,
+    strategy: str = "paranoid",
+    mtime_tolerance: float = DEFAULT_MTIME_TOLERANCE
+) -> Optional[bool]:
+    """Decide from size and mtime alone whether two files hold the same content.
+
+    Returns None when ``strategy`` needs the hashes to tell, see should_sync_files.
+    """
+    same_size = src_info['size'] == target_info['size']
+    mtime_delta = abs(src_info['mtime_ns'] - target_info['mtime_ns'])
+
+    if strategy == "quick":
+        return same_size and mtime_delta == 0
+    if strategy == "checksum-on-ambiguity" and not (
+            same_size and mtime_delta <= mtime_tolerance * 1_000_000_000):
+        return False
+    return None
+
+def should_sync_files(
+    src_path: Path,
+    target_path: Path,
+    strategy: str = "paranoid",
+    mtime_tolerance: float = DEFAULT_MTIME_TOLERANCE,
+    newer_target_wins: bool = True
+) -> bool:
+    """Determine if files should be synchronized based on content and timestamps.
+
+    ``strategy`` decides how "same content" is detected:
+
+    - ``quick``: same size and same ``mtime_ns``, no hashing.
+    - ``checksum-on-ambiguity``: hash only when the sizes match and the
+      mtimes are within ``mtime_tolerance`` seconds; otherwise the files
+      are treated as different.
+    - ``paranoid``: always compare full hashes.
+
+    A newer target with different content is kept unless
+    ``newer_target_wins`` is false, as for mirrors.
+    """
     if not src_path.exists():
         return False
-        
-    src_info = get_file_info(src_path)
-    target_info = get_file_info(target_path)
+
+    src_info = get_file_info(src_path, with_hash=False)
+    target_info = get_file_info(target_path, with_hash=False)
+    if not target_info['exists']:
+        return True
+
+    identical = stat_identical(src_info, target_info, strategy, mtime_tolerance)
+    if identical is None:
+        identical = get_file_hash(src_path) == get_file_hash(target_path)
     
-    # If hashes are different, the newer file should win
-    if src_info['hash'] != target_info['hash']:
+    # If content is different, the newer file should win
+    if not identical:
         # If target is newer and has different content, don't sync
-        if target_info['mtime'] > src_info['mtime']:
+        if newer_target_wins and target_info['mtime_ns'] > src_info['mtime_ns']:
             logger.info(f"Target file is newer with different content: {target_path}")
             return False
             
         # If source is newer or same time but different content, do sync
         return True
         
-    # If hashes are same, files are identical - no need to sync
+    # Files are identical - no need to sync
     return False
 
+def make_comparator(
+    strategy: str = "paranoid",
+    mtime_tolerance: float = DEFAULT_MTIME_TOLERANCE
+) -> Callable[[Path, Path], bool]:
+    """Return should_sync_files bound to a comparison strategy.
+
+    Comparators take ``newer_target_wins=False`` when syncing to a mirror.
+    """
+    if strategy not in COMPARE_STRATEGIES:
+        raise ValueError(f"Unknown compare strategy '{strategy}'")
+    return partial(should_sync_files, strategy=strategy, mtime_tolerance=mtime_tolerance)
+
 def get_delete_filename(path: Path) -> Path:
     """Generate a backup filename for deleted files."""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     return path.parent / f"{path.name}.deleted.at{timestamp}"
 
+def is_deleted_backup(name: str) -> bool:
+    """Check whether a file name was produced by get_delete_filename."""
+    return DELETED_BACKUP_PATTERN.search(name) is not None
+
 def safe_delete(path: Path) -> None:
     """Safely 'delete' a file by renaming it with a timestamp."""
     if not path.exists():
@@ -102,65 +257,154 @@ def sync_file_operation(
     src_path: Path,
     folders: List[Path],
     operation: str,
-    src_root: Path
+    src_root: Path,
+    trees: Optional[Dict[Path, "MerkleTree"]] = None,
+    should_sync: Callable[[Path, Path], bool] = should_sync_files,
+    mirrors: Collection[Path] = ()
 ) -> None:
-    """Synchronize file operations across folders."""
+    """Synchronize file operations across folders.
+
+    When ``trees`` maps replica roots to their MerkleTree, every path that
+    is changed here is also refreshed in the corresponding tree.
+    ``should_sync`` compares source and target, see make_comparator; in
+    ``mirrors`` a newer target never wins.
+    """
     try:
         # Calculate relative path
         rel_path = src_path.relative_to(src_root)
+
+        if trees and src_root in trees:
+            trees[src_root].update(rel_path)
         
         for folder in folders:
             if folder == src_root:
                 continue
                 
             target_path = folder / rel_path
+            overwrite = {'newer_target_wins': False} if folder in mirrors else {}
             
-            if operation == "created" or operation == "modified":
-                # Skip if source file is being edited
-                if is_file_in_use(src_path):
-                    logger.info(f"Skipping sync as source file is being edited: {src_path}")
-                    return
-
-                # Skip if target file is being edited
-                if target_path.exists() and is_file_in_use(target_path):
-                    logger.info(f"Skipping sync as target file is being edited: {target_path}")
-                    return
-
-                # For files, check content and timestamps
-                if src_path.is_file():
-                    if not should_sync_files(src_path, target_path):
-                        return
-                        
-                    # Add a small delay to ensure file is completely written
-                    time.sleep(0.1)
-                    
-                    # Double check content hasn't changed during delay
-                    if not should_sync_files(src_path, target_path):
+            with tracer.span("target", target=target_path):
+                if operation == "created" or operation == "modified":
+                    # Skip if source file is being edited
+                    with tracer.span("is_file_in_use", path=src_path):
+                        in_use = is_file_in_use(src_path)
+                    if in_use:
+                        logger.info(f"Skipping sync as source file is being edited: {src_path}")
                         return
-                        
-                    # Proceed with copy
-                    target_path.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(src_path, target_path)
-                    logger.info(f"Synchronized: {target_path}")
-                    
-                elif src_path.is_dir():
-                    target_path.mkdir(parents=True, exist_ok=True)
-                    
-            elif operation == "deleted":
-                if target_path.exists():
+
                     # Skip if target file is being edited
-                    if is_file_in_use(target_path):
-                        logger.info(f"Skipping deletion as file is being edited: {target_path}")
+                    with tracer.span("is_file_in_use", path=target_path):
+                        in_use = target_path.exists() and is_file_in_use(target_path)
+                    if in_use:
+                        logger.info(f"Skipping sync as target file is being edited: {target_path}")
                         return
+
+                    # For files, check content and timestamps
+                    if src_path.is_file():
+                        with tracer.span("should_sync", path=target_path):
+                            needed = should_sync(src_path, target_path, **overwrite)
+                        if not needed:
+                            return
+                            
+                        # Add a small delay to ensure file is completely written
+                        with tracer.span("settle_delay"):
+                            time.sleep(0.1)
                         
-                    if target_path.is_file():
-                        # Instead of deleting, rename with timestamp
-                        safe_delete(target_path)
-                    elif target_path.is_dir():
-                        # For directories, rename the entire directory
-                        safe_delete(target_path)
+                        # Double check content hasn't changed during delay
+                        with tracer.span("should_sync", path=target_path, recheck=True):
+                            needed = should_sync(src_path, target_path, **overwrite)
+                        if not needed:
+                            return
+                            
+                        # Proceed with copy
+                        with tracer.span("copy_file", path=target_path):
+                            target_path.parent.mkdir(parents=True, exist_ok=True)
+                            copy_file(src_path, target_path)
+                        logger.info(f"Synchronized: {target_path}")
                         
+                    elif src_path.is_dir():
+                        target_path.mkdir(parents=True, exist_ok=True)
+                        
+                elif operation == "deleted":
+                    if target_path.exists():
+                        # Skip if target file is being edited
+                        with tracer.span("is_file_in_use", path=target_path):
+                            in_use = target_path.is_file() and is_file_in_use(target_path)
+                        if in_use:
+                            logger.info(f"Skipping deletion as file is being edited: {target_path}")
+                            return
+                            
+                        with tracer.span("safe_delete", path=target_path):
+                            if target_path.is_file():
+                                # Instead of deleting, rename with timestamp
+                                safe_delete(target_path)
+                            elif target_path.is_dir():
+                                # For directories, rename the entire directory
+                                safe_delete(target_path)
+                            
+                if trees and folder in trees:
+                    with tracer.span("merkle_update", path=rel_path):
+                        trees[folder].update(rel_path)
+
             logger.info(f"{operation.capitalize()}: {target_path}")
             
     except Exception as e:
-        logger.error(f"Failed to sync {operation} for {src_path}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Failed to sync {operation} for {src_path}: {str(e)}")
+
+def rescan_subtree(
+    src_root: Path,
+    subtree: Path,
+    folders: List[Path],
+    trees: Optional[Dict[Path, "MerkleTree"]] = None,
+    should_sync: Callable[[Path, Path], bool] = should_sync_files,
+    mirrors: Collection[Path] = ()
+) -> None:
+    """Re-synchronize everything below ``subtree`` after events were dropped.
+
+    With a ready MerkleTree for the source, the subtree is refreshed in
+    the source tree and in each target's, which costs a stat per file and
+    rehashes only changed signatures, and only the differing paths are
+    synced. Files the source tree knew before the refresh but which are
+    gone are synced as deleted; paths only present in a target are left
+    to that folder's own watch. Without a ready tree deletions cannot be
+    told apart from files that only exist in the other replicas, so every
+    file still present is synced as modified and nothing is deleted.
+    """
+    tree = trees.get(src_root) if trees else None
+    rel_subtree = subtree.relative_to(src_root)
+    logger.info(f"Rescanning {subtree}")
+
+    if tree is None or not tree.ready:
+        for dirpath, dirnames, filenames in os.walk(subtree):
+            for filename in filenames:
+                if not is_deleted_backup(filename):
+                    sync_file_operation(Path(dirpath) / filename, folders, "modified",
+                                        src_root, trees, should_sync, mirrors)
+        return
+
+    known = set(tree.files_under(rel_subtree))
+    tree.refresh(rel_subtree)
+    current = set(tree.files_under(rel_subtree))
+    deleted = known - current
+
+    for folder in folders:
+        if folder == src_root:
+            continue
+        target_tree = trees.get(folder)
+        if target_tree is None or not target_tree.ready:
+            changed = current | deleted
+        else:
+            target_tree.refresh(rel_subtree)
+            changed = set()
+            for rel in tree.diff(target_tree, rel_subtree):
+                if rel in current or rel in deleted:
+                    changed.add(rel)
+                else:
+                    # A directory missing on one side as a whole
+                    changed.update(tree.files_under(Path(rel)))
+                    changed.update(path for path in deleted if path.startswith(f"{rel}/"))
+
+        for rel in sorted(changed):
+            operation = "deleted" if rel in deleted else "modified"
+            sync_file_operation(src_root / rel, [folder], operation, src_root, trees,
+                                should_sync, mirrors)
@@ -1,10 +1,19 @@
 import sys
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 from .main_window import SyncConfigWindow
+from ..tracing import install_signal_handlers
 
 def main():
     app = QApplication(sys.argv)
     window = SyncConfigWindow()
+    # Signal handlers only run in the main thread, once it executes Python
+    # code again, so wake it periodically; this also keeps the tray menu
+    # in step with tracing toggled by SIGUSR1
+    install_signal_handlers()
+    timer = QTimer()
+    timer.timeout.connect(window.sync_tracing_actions)
+    timer.start(500)
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
@@ -43,6 +43,12 @@ class I18n:
                 'stop_sync': "Stop Sync",
                 'sync_status': "Sync Status",
                 'hide_window': "Hide Window",
+                'sync_workers': "Synchronization is running ({}/{} workers, {} restarts, {} pending)",
+                'tracing': "Tracing",
+                'profiling': "Sampled Profiling",
+                'dump_trace': "Dump Trace",
+                'trace_dumped': "Trace written to {}",
+                'failed_dump_trace': "Failed to write trace",
             },
             'zh': {
                 'window_title': "文件夹同步配置",
@@ -78,6 +84,12 @@ class I18n:
                 'stop_sync': "停止同步",
                 'sync_status': "同步状态",
                 'hide_window': "隐藏窗口",
+                'sync_workers': "同步正在运行（{}/{} 个工作进程，重启 {} 次，待处理 {}）",
+                'tracing': "追踪",
+                'profiling': "采样性能分析",
+                'dump_trace': "导出追踪",
+                'trace_dumped': "追踪已写入 {}",
+                'failed_dump_trace': "导出追踪失败",
             }
         }
         
@@ -9,9 +9,23 @@ import logging
 import asyncio
 from .i18n import i18n
 from .icons import create_default_icon
+from ..tracing import DEFAULT_PROFILE_RATE, tracer
 
 logger = logging.getLogger(__name__)
 
+def folder_path(entry) -> str:
+    """Return the path of a folder entry, which may carry per-folder options."""
+    if isinstance(entry, dict):
+        return str(entry.get('path', ''))
+    return str(entry)
+
+def remove_folder_entry(entries: list, path: str) -> None:
+    """Remove the folder entry with the given path."""
+    for entry in entries:
+        if folder_path(entry) == path:
+            entries.remove(entry)
+            return
+
 class SyncThread(QThread):
     error_occurred = pyqtSignal(str)
     status_changed = pyqtSignal(str)
@@ -35,7 +49,7 @@ class SyncThread(QThread):
             while self._is_running:
                 try:
                     # 创建并保存当前任务的引用
-                    self._current_task = self._loop.create_task(main())
+                    self._current_task = self._loop.create_task(main(self._report_health))
                     
                     # 等待任务完成或被取消
                     try:
@@ -65,6 +79,14 @@ class SyncThread(QThread):
         finally:
             self._cleanup()
 
+    def _report_health(self, health):
+        """汇总工作进程的健康状况和指标"""
+        alive = sum(1 for shard in health.values() if shard['alive'])
+        restarts = sum(shard['restarts'] for shard in health.values())
+        pending = sum(group.get('pending', 0)
+                      for shard in health.values() for group in shard['groups'].values())
+        self.status_changed.emit(i18n.get('sync_workers', alive, len(health), restarts, pending))
+
     def _cleanup(self):
         """清理资源"""
         try:
@@ -156,6 +178,20 @@ class SyncConfigWindow(QMainWindow):
         self.stop_sync_action.triggered.connect(self.stop_sync)
         self.stop_sync_action.setVisible(False)
         
+        self.tray_menu.addSeparator()
+
+        # 追踪和性能分析
+        self.tracing_action = self.tray_menu.addAction(i18n.get('tracing'))
+        self.tracing_action.setCheckable(True)
+        self.tracing_action.triggered.connect(self.toggle_tracing)
+
+        self.profiling_action = self.tray_menu.addAction(i18n.get('profiling'))
+        self.profiling_action.setCheckable(True)
+        self.profiling_action.triggered.connect(self.toggle_profiling)
+
+        dump_trace_action = self.tray_menu.addAction(i18n.get('dump_trace'))
+        dump_trace_action.triggered.connect(self.dump_trace)
+
         self.tray_menu.addSeparator()
         
         # 退出按钮
@@ -166,6 +202,41 @@ class SyncConfigWindow(QMainWindow):
         self.tray_icon.activated.connect(self.tray_icon_activated)
         self.tray_icon.show()
 
+    def toggle_tracing(self, checked):
+        """开启或关闭追踪"""
+        if checked:
+            tracer.enable(tracer.profile_rate)
+        else:
+            tracer.disable()
+            self.profiling_action.setChecked(False)
+
+    def toggle_profiling(self, checked):
+        """开启或关闭采样性能分析（同时开启追踪）"""
+        if checked:
+            tracer.enable(DEFAULT_PROFILE_RATE)
+            self.tracing_action.setChecked(True)
+        else:
+            tracer.profile_rate = 0.0
+
+    def sync_tracing_actions(self):
+        """让托盘菜单反映追踪状态（可能已通过信号切换）"""
+        self.tracing_action.setChecked(tracer.enabled)
+        self.profiling_action.setChecked(tracer.enabled and tracer.profile_rate > 0)
+
+    def dump_trace(self):
+        """导出 Chrome 追踪文件"""
+        try:
+            path = tracer.dump()
+            self.tray_icon.showMessage(
+                i18n.get('dump_trace'),
+                i18n.get('trace_dumped', path),
+                QSystemTrayIcon.Information,
+                2000
+            )
+        except Exception as e:
+            logger.error(f"{i18n.get('failed_dump_trace')}: {e}")
+            QMessageBox.warning(self, i18n.get('error'), f"{i18n.get('failed_dump_trace')}: {e}")
+
     def toggle_window(self):
         """切换窗口显示状态"""
         if self.isVisible():
@@ -335,13 +406,13 @@ class SyncConfigWindow(QMainWindow):
         # 添加默认同步组
         default_group = QTreeWidgetItem(self.tree, [i18n.get('default_group')])
         for folder in self.config_data.get('folders', []):
-            QTreeWidgetItem(default_group, [str(folder)])
+            QTreeWidgetItem(default_group, [folder_path(folder)])
         
         # 添加其他同步组
         for group_name, folders in self.config_data.get('folder_groups', {}).items():
             group_item = QTreeWidgetItem(self.tree, [group_name])
             for folder in folders:
-                QTreeWidgetItem(group_item, [str(folder)])
+                QTreeWidgetItem(group_item, [folder_path(folder)])
         
         self.tree.expandAll()
 
@@ -390,11 +461,11 @@ class SyncConfigWindow(QMainWindow):
                 del self.config_data['folder_groups'][group_name]
         else:  # 文件夹节点
             group_item = item.parent()
-            folder_path = item.text(0)
+            folder = item.text(0)
             if group_item.text(0) == i18n.get('default_group'):
-                self.config_data['folders'].remove(folder_path)
+                remove_folder_entry(self.config_data['folders'], folder)
             else:
-                self.config_data['folder_groups'][group_item.text(0)].remove(folder_path)
+                remove_folder_entry(self.config_data['folder_groups'][group_item.text(0)], folder)
 
         self.update_tree()
 
@@ -1,31 +1,42 @@
 from .config_loader import load_config
 from .sync_manager import start_sync
+from .supervisor import Supervisor, shard_groups
+from .tracing import install_signal_handlers
 import logging
 import asyncio
-from typing import Dict, List
-from pathlib import Path
+from typing import Any, Callable, Dict, Optional
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-async def sync_group(group_name: str, folders: List[Path]):
+async def sync_group(group_name: str, group: Dict[str, Any]):
     """Synchronize a single group of folders."""
     try:
         logging.info(f"Starting synchronization for group: {group_name}")
-        await start_sync(folders)
+        await start_sync(group["folders"], group["folder_options"], group_name,
+                         group["modes"], group["options"], group["remotes"])
     except Exception as e:
         logging.error(f"Error in group {group_name}: {str(e)}")
 
-async def main():
+async def main(on_health: Optional[Callable[[Dict[str, Dict[str, Any]]], None]] = None):
+    """Run every group, in this process or in supervised worker processes.
+
+    ``on_health`` receives the workers' health and metrics whenever they change.
+    """
     try:
+        install_signal_handlers()
         folder_groups = load_config()
+        local_groups, shards = shard_groups(folder_groups)
         tasks = []
         
-        for group_name, folders in folder_groups.items():
-            logging.info(f"Initializing group {group_name} with folders: {folders}")
-            tasks.append(sync_group(group_name, folders))
+        for group_name, group in local_groups.items():
+            logging.info(f"Initializing group {group_name} with folders: {group['folders']}")
+            tasks.append(sync_group(group_name, group))
+
+        if shards:
+            tasks.append(Supervisor(shards, on_health).run())
             
         await asyncio.gather(*tasks)
         
@@ -0,0 +1,345 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+import hashlib
+import json
+import logging
+import os
+import threading
+from .file_handler import get_file_hash, is_deleted_backup
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+INDEX_DIR = Path.home() / ".localsync" / "index"
+
+def index_path(root: Path) -> Path:
+    """Location of the persisted index for a replica root."""
+    key = hashlib.md5(str(root).encode('utf-8')).hexdigest()
+    return INDEX_DIR / f"{key}.json"
+
+def _join(parent: str, name: str) -> str:
+    return f"{parent}/{name}" if parent else name
+
+def _parent(rel: str) -> str:
+    return rel.rpartition('/')[0]
+
+class MerkleTree:
+    """Merkle tree of directory digests for a single replica.
+
+    File leaves carry the content digest, cached against the file's stat
+    signature (size, mtime_ns) so refreshing an unchanged tree only costs
+    one stat per file. Directory digests are built from the sorted child
+    names, kinds and digests, so two replicas with the same content have
+    the same root digest regardless of their timestamps.
+
+    Updates for single files only stat them: the leaf is marked stale and
+    hashed, along with the directories above it, the next time a digest
+    is needed, so content hashing stays off the event path.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.ready = False
+        self._lock = threading.RLock()
+        self._files: Dict[str, Tuple[int, int, str]] = {}
+        self._dirs: Dict[str, str] = {}
+        self._children: Dict[str, Set[str]] = {'': set()}
+        self._pending: Set[str] = set()
+        self._stale: Set[str] = set()
+        self._dirty: Set[str] = set()
+
+    @property
+    def digest(self) -> str:
+        with self._lock:
+            self._flush()
+            return self._dirs.get('', '')
+
+    def build(self, cache: Optional[Dict[str, Tuple[int, int, str]]] = None) -> None:
+        """Scan the replica, reusing cached digests whose stat signature matches."""
+        cache = cache if cache is not None else self._files
+        files: Dict[str, Tuple[int, int, str]] = {}
+        children: Dict[str, Set[str]] = {'': set()}
+        self._scan('', cache, files, children)
+
+        with self._lock:
+            self._files = files
+            self._children = children
+            self._dirs = {}
+            self._stale.clear()
+            self._dirty.clear()
+            self._rehash_subtree('')
+            self.ready = True
+            pending, self._pending = self._pending, set()
+            for rel in sorted(pending):
+                self._update(rel)
+
+    def _scan(self, rel_dir: str, cache, files, children) -> None:
+        try:
+            entries = list(os.scandir(self.root / rel_dir if rel_dir else self.root))
+        except OSError as e:
+            logger.warning(f"Failed to scan {self.root / rel_dir}: {str(e)}")
+            return
+
+        for entry in entries:
+            if is_deleted_backup(entry.name):
+                continue
+            rel = _join(rel_dir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    children[rel_dir].add(entry.name)
+                    children[rel] = set()
+                    self._scan(rel, cache, files, children)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[rel] = self._leaf(Path(entry.path), st, cache.get(rel))
+                    children[rel_dir].add(entry.name)
+            except OSError:
+                continue
+
+    @staticmethod
+    def _leaf(path: Path, st: os.stat_result, cached) -> Tuple[int, int, str]:
+        # Stale leaves carry no digest yet and are hashed again
+        if cached and cached[2] and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached
+        return (st.st_size, st.st_mtime_ns, get_file_hash(path))
+
+    def _rehash_dir(self, rel_dir: str) -> None:
+        h = hashlib.md5()
+        for name in sorted(self._children.get(rel_dir, ())):
+            rel = _join(rel_dir, name)
+            if rel in self._children:
+                h.update(f"d\0{name}\0{self._dirs.get(rel, '')}\n".encode('utf-8'))
+            elif rel in self._files:
+                h.update(f"f\0{name}\0{self._files[rel][2]}\n".encode('utf-8'))
+        self._dirs[rel_dir] = h.hexdigest()
+
+    def _rehash_subtree(self, rel_dir: str) -> None:
+        for name in self._children.get(rel_dir, ()):
+            rel = _join(rel_dir, name)
+            if rel in self._children:
+                self._rehash_subtree(rel)
+        self._rehash_dir(rel_dir)
+
+    def _rehash_ancestors(self, rel: str) -> None:
+        while rel:
+            rel = _parent(rel)
+            self._dirty.add(rel)
+
+    def _flush(self) -> None:
+        """Hash stale leaves, then the directories above them, deepest first."""
+        for rel in sorted(self._stale):
+            if rel not in self._files:
+                continue
+            path = self.root / rel
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            self._files[rel] = (st.st_size, st.st_mtime_ns, get_file_hash(path))
+        self._stale.clear()
+
+        for rel_dir in sorted(self._dirty, key=lambda rel: rel.count('/') if rel else -1,
+                              reverse=True):
+            if rel_dir in self._children:
+                self._rehash_dir(rel_dir)
+        self._dirty.clear()
+
+    def _remove(self, rel: str) -> None:
+        for name in self._children.pop(rel, set()):
+            self._remove(_join(rel, name))
+        self._files.pop(rel, None)
+        self._dirs.pop(rel, None)
+        self._stale.discard(rel)
+
+    def update(self, rel_path: Path) -> None:
+        """Re-examine one path after a change and refresh the digests above it."""
+        rel = Path(rel_path).as_posix()
+        if rel in ('', '.') or any(is_deleted_backup(part) for part in rel.split('/')):
+            return
+        with self._lock:
+            if not self.ready:
+                self._pending.add(rel)
+                return
+            self._update(rel)
+
+    def _update(self, rel: str) -> None:
+        path = self.root / rel
+        parent = _parent(rel)
+        name = rel.rpartition('/')[2]
+
+        try:
+            st = path.stat()
+            exists = True
+        except OSError:
+            exists = False
+
+        if not exists:
+            self._remove(rel)
+            if parent in self._children:
+                self._children[parent].discard(name)
+            self._rehash_ancestors(rel)
+            return
+
+        # Make sure every ancestor exists as a directory node
+        ancestor, child = parent, name
+        while True:
+            created = ancestor not in self._children
+            self._children.setdefault(ancestor, set()).add(child)
+            if not ancestor or not created:
+                break
+            ancestor, child = _parent(ancestor), ancestor.rpartition('/')[2]
+
+        if path.is_dir():
+            files: Dict[str, Tuple[int, int, str]] = {}
+            children: Dict[str, Set[str]] = {rel: set()}
+            self._scan(rel, self._files, files, children)
+            self._remove(rel)
+            self._files.update(files)
+            self._children.update(children)
+            self._rehash_subtree(rel)
+        else:
+            cached = self._files.get(rel)
+            self._remove(rel)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                self._files[rel] = cached
+            else:
+                self._files[rel] = (st.st_size, st.st_mtime_ns, '')
+                self._stale.add(rel)
+        self._rehash_ancestors(rel)
+
+    def refresh(self, rel_dir: Path) -> None:
+        """Re-scan a subtree, rehashing only files whose stat signature changed."""
+        rel = Path(rel_dir).as_posix()
+        if rel in ('', '.'):
+            self.build()
+        else:
+            self.update(rel_dir)
+
+    def file_hash(self, rel_path: Path) -> str:
+        """Content digest of one file, taken from its leaf while the stat signature matches."""
+        rel = Path(rel_path).as_posix()
+        path = self.root / rel
+        try:
+            st = path.stat()
+        except OSError:
+            return ''
+        with self._lock:
+            leaf = self._files.get(rel)
+        if leaf and leaf[2] and leaf[0] == st.st_size and leaf[1] == st.st_mtime_ns:
+            return leaf[2]
+        return get_file_hash(path)
+
+    def files_under(self, rel_dir: Path) -> List[str]:
+        """Relative paths of the indexed files below ``rel_dir``."""
+        rel = Path(rel_dir).as_posix()
+        rel = '' if rel == '.' else rel
+        with self._lock:
+            result: List[str] = []
+            stack = [rel] if rel in self._children else []
+            if rel in self._files:
+                result.append(rel)
+            while stack:
+                rel_dir = stack.pop()
+                for name in self._children.get(rel_dir, ()):
+                    child = _join(rel_dir, name)
+                    if child in self._children:
+                        stack.append(child)
+                    elif child in self._files:
+                        result.append(child)
+            return result
+
+    def diff(self, other: "MerkleTree", rel_dir: Path = Path('.')) -> List[str]:
+        """Relative paths that differ, descending only into differing subtrees.
+
+        ``rel_dir`` limits the comparison to the subtree below it.
+        """
+        rel = Path(rel_dir).as_posix()
+        rel = '' if rel == '.' else rel
+        # Take both locks in a fixed order so that a.diff(b) and b.diff(a)
+        # running on different threads cannot deadlock
+        first, second = sorted((self, other), key=id)
+        with first._lock, second._lock:
+            self._flush()
+            other._flush()
+            result: List[str] = []
+            if rel in self._children and rel in other._children:
+                self._diff_dir(other, rel, result)
+            elif rel in self._children or rel in other._children:
+                result.append(rel)
+            return result
+
+    def _diff_dir(self, other: "MerkleTree", rel_dir: str, result: List[str]) -> None:
+        if self._dirs.get(rel_dir) == other._dirs.get(rel_dir):
+            return
+        names = self._children.get(rel_dir, set()) | other._children.get(rel_dir, set())
+        for name in sorted(names):
+            rel = _join(rel_dir, name)
+            if rel in self._children and rel in other._children:
+                self._diff_dir(other, rel, result)
+            elif rel in self._files and rel in other._files:
+                if self._files[rel][2] != other._files[rel][2]:
+                    result.append(rel)
+            else:
+                result.append(rel)
+
+    def save(self, path: Path) -> None:
+        """Persist file signatures so the next build only needs to stat."""
+        with self._lock:
+            self._flush()
+            data = {
+                'version': INDEX_VERSION,
+                'root': str(self.root),
+                'files': {rel: list(leaf) for rel, leaf in self._files.items()}
+            }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load_cache(path: Path) -> Dict[str, Tuple[int, int, str]]:
+        """Load persisted file signatures, returning an empty cache on any problem."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != INDEX_VERSION:
+                return {}
+            return {rel: tuple(leaf) for rel, leaf in data['files'].items()}
+        except Exception:
+            return {}
+
+def build_trees(trees: Dict[Path, MerkleTree], persist: bool = True) -> None:
+    """Build every replica's tree from its persisted index and log differences."""
+    for root, tree in trees.items():
+        cache = MerkleTree.load_cache(index_path(root)) if persist else None
+        tree.build(cache)
+        logger.info(f"Merkle index ready for {root}: {tree.digest}")
+
+    if persist:
+        save_trees(trees)
+
+    for root, paths in compare_replicas(trees).items():
+        logger.info(f"Replica {root} differs in {len(paths)} path(s): {paths[:10]}")
+
+def save_trees(trees: Dict[Path, MerkleTree]) -> None:
+    """Persist the index of every tree that finished building."""
+    for root, tree in trees.items():
+        if not tree.ready:
+            continue
+        try:
+            tree.save(index_path(root))
+        except OSError as e:
+            logger.warning(f"Failed to save index for {root}: {str(e)}")
+
+def compare_replicas(trees: Dict[Path, MerkleTree]) -> Dict[Path, List[str]]:
+    """Compare every replica against the first one by root digest."""
+    items = list(trees.items())
+    if not items:
+        return {}
+    _, reference = items[0]
+    result = {}
+    for root, tree in items[1:]:
+        if tree.digest != reference.digest:
+            result[root] = reference.diff(tree)
+    return result
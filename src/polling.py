@@ -0,0 +1,265 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from functools import partial
+import logging
+import os
+import time
+from watchdog.events import (
+    DirCreatedEvent,
+    DirDeletedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+)
+from watchdog.observers.api import (
+    DEFAULT_EMITTER_TIMEOUT,
+    DEFAULT_OBSERVER_TIMEOUT,
+    BaseObserver,
+    EventEmitter,
+)
+from .file_handler import is_deleted_backup
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_STAT_BUDGET = 2000  # stat calls per second
+SLICE_SIZE = 256
+# Directories modified this recently are listed again on the next pass,
+# since coarse network filesystem mtimes may hide a second change
+RACY_WINDOW_NS = 2_000_000_000
+
+EVENT_CLASSES = {
+    ("created", False): FileCreatedEvent,
+    ("created", True): DirCreatedEvent,
+    ("modified", False): FileModifiedEvent,
+    ("deleted", False): FileDeletedEvent,
+    ("deleted", True): DirDeletedEvent,
+}
+
+PollEvent = Tuple[str, str, bool]
+
+class PollingSnapshot:
+    """Compact snapshot of a directory tree that is re-checked in slices.
+
+    A directory is listed again only when its own mtime changed, which is
+    how entries being added, removed or renamed show up; unchanged
+    directories cost a single stat. Files are re-stat'ed to catch in-place
+    modifications. ``step`` checks a bounded number of entries so a full
+    pass can be spread over time; after ``reset`` the initial snapshot is
+    taken the same way, without reporting events, until ``ready``.
+    """
+
+    def __init__(self, root: Path):
+        self.root = str(root)
+        self._dirs: Dict[str, Optional[int]] = {}
+        self._files: Dict[str, Tuple[int, int]] = {}
+        self._children: Dict[str, Set[str]] = {}
+        self._work: List[str] = []
+        # Directories still to be listed for the initial snapshot
+        self._unlisted: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._dirs) + len(self._files)
+
+    @property
+    def ready(self) -> bool:
+        return not self._unlisted
+
+    def reset(self) -> None:
+        """Forget everything and start taking the initial snapshot."""
+        self._dirs.clear()
+        self._files.clear()
+        self._children.clear()
+        self._work = []
+        self._unlisted = ['']
+
+    def build(self) -> None:
+        """Take the initial snapshot at once, without reporting any events."""
+        self.reset()
+        while not self.ready:
+            self.step(SLICE_SIZE)
+
+    def _list_dir(self, rel: str) -> int:
+        """List one directory of the initial snapshot, returning the entries checked."""
+        path = self._path(rel)
+        try:
+            st = os.stat(path)
+            entries = list(os.scandir(path))
+        except OSError:
+            if not rel:
+                logger.warning(f"Failed to list {path}")
+            return 1
+
+        self._dirs[rel] = self._dir_mtime(st)
+        self._children[rel] = set()
+        for entry in entries:
+            if is_deleted_backup(entry.name):
+                continue
+            child = self._join(rel, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    self._children[rel].add(entry.name)
+                    self._unlisted.append(child)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    self._files[child] = (st.st_size, st.st_mtime_ns)
+                    self._children[rel].add(entry.name)
+            except OSError:
+                pass
+        return len(entries) + 1
+
+    def _path(self, rel: str) -> str:
+        return os.path.join(self.root, rel) if rel else self.root
+
+    @staticmethod
+    def _join(parent: str, name: str) -> str:
+        return os.path.join(parent, name) if parent else name
+
+    def _add_dir(self, rel: str, events: List[PollEvent]) -> None:
+        path = self._path(rel)
+        try:
+            st = os.stat(path)
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+
+        self._dirs[rel] = self._dir_mtime(st)
+        self._children[rel] = set()
+        events.append(("created", path, True))
+
+        for entry in entries:
+            self._add_entry(rel, entry, events)
+
+    def _add_entry(self, rel_dir: str, entry: os.DirEntry, events: List[PollEvent]) -> None:
+        if is_deleted_backup(entry.name):
+            return
+        rel = self._join(rel_dir, entry.name)
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                self._children[rel_dir].add(entry.name)
+                self._add_dir(rel, events)
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                self._files[rel] = (st.st_size, st.st_mtime_ns)
+                self._children[rel_dir].add(entry.name)
+                events.append(("created", entry.path, False))
+        except OSError:
+            pass
+
+    def _remove(self, rel: str, events: List[PollEvent]) -> None:
+        if rel in self._dirs:
+            for name in self._children.pop(rel, set()):
+                self._remove(self._join(rel, name), events)
+            del self._dirs[rel]
+            events.append(("deleted", self._path(rel), True))
+        elif rel in self._files:
+            del self._files[rel]
+            events.append(("deleted", self._path(rel), False))
+
+    @staticmethod
+    def _dir_mtime(st: os.stat_result) -> Optional[int]:
+        if time.time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            return None
+        return st.st_mtime_ns
+
+    def _check_dir(self, rel: str, events: List[PollEvent]) -> None:
+        path = self._path(rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return  # Reported when the parent directory is listed
+        if self._dirs[rel] is not None and st.st_mtime_ns == self._dirs[rel]:
+            return
+
+        try:
+            entries = {entry.name: entry for entry in os.scandir(path)
+                       if not is_deleted_backup(entry.name)}
+        except OSError:
+            return
+        self._dirs[rel] = self._dir_mtime(st)
+
+        known = self._children[rel]
+        for name in list(known):
+            child = self._join(rel, name)
+            entry = entries.get(name)
+            if entry is None or (child in self._dirs) != entry.is_dir(follow_symlinks=False):
+                self._remove(child, events)
+                known.discard(name)
+        for name, entry in entries.items():
+            if name not in known:
+                self._add_entry(rel, entry, events)
+
+    def _check_file(self, rel: str, events: List[PollEvent]) -> None:
+        try:
+            st = os.stat(self._path(rel))
+        except OSError:
+            return  # Reported when the parent directory is listed
+        signature = (st.st_size, st.st_mtime_ns)
+        if self._files[rel] != signature:
+            self._files[rel] = signature
+            events.append(("modified", self._path(rel), False))
+
+    def step(self, count: int) -> List[PollEvent]:
+        """Check up to ``count`` entries, starting a new pass when the last one ended."""
+        if self._unlisted:
+            while self._unlisted and count > 0:
+                count -= self._list_dir(self._unlisted.pop())
+            return []
+
+        if not self._work:
+            # Directories first so additions and removals are found early
+            self._work = list(self._files) + sorted(self._dirs, reverse=True)
+
+        events: List[PollEvent] = []
+        for _ in range(min(count, len(self._work))):
+            rel = self._work.pop()
+            if rel in self._dirs:
+                self._check_dir(rel, events)
+            elif rel in self._files:
+                self._check_file(rel, events)
+        return events
+
+class IncrementalPollingEmitter(EventEmitter):
+    """Emitter that polls a PollingSnapshot in slices spread over the interval."""
+
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT,
+                 interval: float = DEFAULT_POLL_INTERVAL,
+                 stat_budget: float = DEFAULT_STAT_BUDGET):
+        super().__init__(event_queue, watch, timeout)
+        self._interval = interval
+        self._stat_budget = stat_budget
+        self._snapshot = PollingSnapshot(Path(watch.path))
+
+    def on_thread_start(self):
+        # Runs in the thread starting the observer, so the snapshot itself
+        # is taken in slices by queue_events
+        self._snapshot.reset()
+
+    def queue_events(self, timeout):
+        if not self._snapshot.ready:
+            if self.stopped_event.wait(SLICE_SIZE / self._stat_budget):
+                return
+            self._snapshot.step(SLICE_SIZE)
+            if self._snapshot.ready:
+                logger.info(f"Polling {len(self._snapshot)} entries under {self.watch.path}")
+            return
+
+        # One full pass per interval, never exceeding the stat budget
+        total = max(len(self._snapshot), 1)
+        count = min(SLICE_SIZE, total)
+        delay = max(self._interval * count / total, count / self._stat_budget)
+        if self.stopped_event.wait(delay):
+            return
+
+        for operation, path, is_directory in self._snapshot.step(count):
+            self.queue_event(EVENT_CLASSES[(operation, is_directory)](path))
+
+class IncrementalPollingObserver(BaseObserver):
+    """Observer for mounts where native change notifications never arrive."""
+
+    def __init__(self, interval: float = DEFAULT_POLL_INTERVAL,
+                 stat_budget: float = DEFAULT_STAT_BUDGET,
+                 timeout=DEFAULT_OBSERVER_TIMEOUT):
+        emitter_class = partial(IncrementalPollingEmitter,
+                                interval=interval, stat_budget=stat_budget)
+        super().__init__(emitter_class=emitter_class, timeout=timeout)
@@ -0,0 +1,243 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 30.0
+MAX_RESTART_DELAY = 60.0
+# A worker running this long without failing restarts its backoff from scratch
+STABLE_PERIOD = 600.0
+
+Groups = Dict[str, Dict[str, Any]]
+
+def shard_groups(folder_groups: Groups) -> Tuple[Groups, Dict[str, Groups]]:
+    """Split groups into those run in this process and worker shards.
+
+    A group's ``process`` option set to true gives it a worker process of
+    its own; a string names a shard shared with other groups using the
+    same name. Groups without it stay in the current process.
+    """
+    local: Groups = {}
+    shards: Dict[str, Groups] = {}
+    for group_name, group in folder_groups.items():
+        process = group.get("options", {}).get("process", False)
+        if not process:
+            local[group_name] = group
+            continue
+        shard = group_name if process is True else str(process)
+        shards.setdefault(shard, {})[group_name] = group
+    return local, shards
+
+def run_worker(shard: str, groups: Groups, health_queue, control_queue=None,
+               tracing: Tuple[bool, float] = (False, 0.0)) -> None:
+    """Entry point of a worker process running one shard of groups.
+
+    ``control_queue`` carries the tracing changes of the supervising process.
+    """
+    from .tracing import install_signal_handlers
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - %(levelname)s - [{shard}] %(message)s'
+    )
+    install_signal_handlers()
+    if tracing[0]:
+        tracer.enable(tracing[1])
+    if control_queue is not None:
+        threading.Thread(target=_follow_tracing, args=(control_queue,), daemon=True).start()
+    asyncio.run(_worker_main(shard, groups, health_queue))
+
+def _follow_tracing(control_queue) -> None:
+    while True:
+        command, *args = control_queue.get()
+        if command == "tracing":
+            enabled, profile_rate = args
+            if enabled:
+                tracer.enable(profile_rate)
+            elif tracer.enabled:
+                tracer.disable()
+        elif command == "dump":
+            try:
+                tracer.dump()
+            except OSError as e:
+                logger.error(f"Failed to write trace: {str(e)}")
+
+def _heartbeat(shard: str, health_queue, stopped: threading.Event) -> None:
+    from .event_queue import queue_stats
+
+    while True:
+        health_queue.put({
+            'shard': shard,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'groups': queue_stats()
+        })
+        if stopped.wait(HEARTBEAT_INTERVAL):
+            return
+
+async def _worker_main(shard: str, groups: Groups, health_queue) -> None:
+    from .sync_manager import start_sync
+
+    # Stop cleanly on terminate so the replica indexes get saved
+    task = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+
+    # Unlike main.sync_group, errors end the process so the supervisor
+    # restarts it
+    tasks = [start_sync(group["folders"], group["folder_options"], group_name,
+                        group["modes"], group["options"], group["remotes"])
+             for group_name, group in groups.items()]
+
+    # Heartbeats come from a thread of their own, so a slow start of a
+    # large group on the event loop does not get the worker killed
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(shard, health_queue, stopped),
+                     daemon=True).start()
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        logger.info(f"Worker {shard} stopping")
+    finally:
+        stopped.set()
+
+class Supervisor:
+    """Run shards of folder groups in worker processes and restart them on failure."""
+
+    def __init__(self, shards: Dict[str, Groups],
+                 on_health: Optional[Callable[[Dict[str, Dict[str, Any]]], None]] = None):
+        self.shards = shards
+        self.on_health = on_health
+        # Spawn, so workers do not inherit the observer and GUI threads
+        self._context = multiprocessing.get_context("spawn")
+        self._health_queue = self._context.Queue()
+        self._processes: Dict[str, multiprocessing.Process] = {}
+        self._controls: Dict[str, Any] = {}
+        self._tracing = (tracer.enabled, tracer.profile_rate, tracer.dumps)
+        self.health: Dict[str, Dict[str, Any]] = {
+            shard: {'pid': None, 'alive': False, 'restarts': 0,
+                    'last_heartbeat': None, 'restart_at': 0.0, 'groups': {}}
+            for shard in shards
+        }
+
+    def _start(self, shard: str) -> None:
+        control_queue = self._context.Queue()
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self.shards[shard], self._health_queue, control_queue,
+                  (tracer.enabled, tracer.profile_rate)),
+            name=f"localsync-{shard}",
+            daemon=True
+        )
+        process.start()
+        self._processes[shard] = process
+        self._controls[shard] = control_queue
+        self.health[shard].update(pid=process.pid, alive=True, last_heartbeat=time.time(),
+                                  started_at=time.time())
+        logger.info(f"Started worker {shard} (pid {process.pid}) for groups: {list(self.shards[shard])}")
+
+    def _stop(self, shard: str) -> None:
+        process = self._processes.pop(shard, None)
+        control_queue = self._controls.pop(shard, None)
+        if control_queue is not None:
+            control_queue.cancel_join_thread()
+            control_queue.close()
+        if process is None:
+            return
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.health[shard]['alive'] = False
+
+    def _drain_health(self) -> bool:
+        changed = False
+        while True:
+            try:
+                report = self._health_queue.get_nowait()
+            except queue.Empty:
+                return changed
+            health = self.health.get(report['shard'])
+            if health is not None and health['pid'] == report['pid']:
+                health.update(last_heartbeat=report['time'], groups=report['groups'])
+                changed = True
+
+    def _check(self, shard: str) -> bool:
+        health = self.health[shard]
+        process = self._processes.get(shard)
+        now = time.time()
+
+        if process is not None:
+            if process.is_alive() and now - health['last_heartbeat'] < HEARTBEAT_TIMEOUT:
+                if health['restarts'] and now - health['started_at'] >= STABLE_PERIOD:
+                    health['restarts'] = 0
+                    return True
+                return False
+            if process.is_alive():
+                logger.warning(f"Worker {shard} missed heartbeats, restarting")
+            else:
+                logger.warning(f"Worker {shard} exited with code {process.exitcode}, restarting")
+            self._stop(shard)
+            delay = min(2 ** health['restarts'], MAX_RESTART_DELAY)
+            health['restarts'] += 1
+            health['restart_at'] = now + delay
+            return True
+
+        if now >= health['restart_at']:
+            self._start(shard)
+            return True
+        return False
+
+    def _forward_tracing(self) -> None:
+        """Mirror tracing changes and dumps of this process onto the workers."""
+        state = (tracer.enabled, tracer.profile_rate, tracer.dumps)
+        if state == self._tracing:
+            return
+        commands = []
+        if state[:2] != self._tracing[:2]:
+            commands.append(("tracing", tracer.enabled, tracer.profile_rate))
+        if state[2] != self._tracing[2]:
+            commands.append(("dump",))
+        self._tracing = state
+
+        # Queued even for workers still starting up, which read them once
+        # they run
+        for control_queue in self._controls.values():
+            for command in commands:
+                control_queue.put(command)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Health and metrics of every shard."""
+        return {shard: dict(health) for shard, health in self.health.items()}
+
+    async def run(self) -> None:
+        """Supervise the workers until cancelled."""
+        try:
+            for shard in self.shards:
+                self._start(shard)
+
+            while True:
+                changed = self._drain_health()
+                for shard in self.shards:
+                    changed = self._check(shard) or changed
+                if changed and self.on_health:
+                    self.on_health(self.snapshot())
+                self._forward_tracing()
+                await asyncio.sleep(1)
+        finally:
+            for shard in list(self._processes):
+                self._stop(shard)
+            logger.info("Workers stopped")
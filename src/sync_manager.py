@@ -1,35 +1,36 @@
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Collection, Dict, List, Optional
 import time
 import asyncio
-from .file_handler import sync_file_operation
+import threading
+from .agent import RemoteReplica
+from .event_queue import PendingQueue, install_overflow_hook
+from .file_handler import (DEFAULT_MTIME_TOLERANCE, make_comparator, rescan_subtree,
+                           should_sync_files, sync_file_operation)
+from .merkle import MerkleTree, build_trees, save_trees
+from .polling import DEFAULT_POLL_INTERVAL, DEFAULT_STAT_BUDGET, IncrementalPollingObserver
+from .tracing import tracer
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_VERIFY_INTERVAL = 300.0
+
 class FolderSyncHandler(FileSystemEventHandler):
-    def __init__(self, folders: List[Path], src_root: Path):
-        self.folders = folders
+    def __init__(self, queue: PendingQueue, src_root: Path):
+        self.queue = queue
         self.src_root = src_root
         super().__init__()
 
     def handle_event(self, event, operation: str):
-        """Generic event handler with synchronization protection."""
+        """Generic event handler, queueing the work for the group's worker."""
         try:
             if event.is_directory:
                 return
 
-            src_path = Path(event.src_path)
-            
-            # Skip if path is already being processed
-            sync_file_operation(
-                src_path,
-                self.folders,
-                operation,
-                self.src_root
-            )
+            self.queue.put(self.src_root, Path(event.src_path), operation)
 
         except Exception as e:
             logger.error(f"Error handling {operation} event: {str(e)}")
@@ -43,26 +44,183 @@ class FolderSyncHandler(FileSystemEventHandler):
     def on_deleted(self, event):
         self.handle_event(event, "deleted")
 
-async def start_sync(folders: List[Path]) -> None:
-    """Start the folder synchronization process."""
-    observer = Observer()
+class SyncWorker(threading.Thread):
+    """Apply the queued work of one group, one item at a time.
+
+    Each item is also handed on to the group's remote replicas, which
+    batch it with others. Folders in ``mirrors`` are overwritten even when
+    their copy is newer.
+    """
+
+    def __init__(self, queue: PendingQueue, folders: List[Path],
+                 trees: Optional[Dict[Path, MerkleTree]] = None,
+                 should_sync: Callable[[Path, Path], bool] = should_sync_files,
+                 remotes: Optional[List[RemoteReplica]] = None,
+                 mirrors: Collection[Path] = ()):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.folders = folders
+        self.trees = trees
+        self.should_sync = should_sync
+        self.remotes = remotes or []
+        self.mirrors = set(mirrors)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            kind, src_root, path, operation = item
+            try:
+                with tracer.profile(), tracer.span(kind, path=path, operation=operation):
+                    if kind == "rescan":
+                        rescan_subtree(src_root, path, self.folders, self.trees,
+                                       self.should_sync, self.mirrors)
+                    else:
+                        sync_file_operation(path, self.folders, operation, src_root,
+                                            self.trees, self.should_sync, self.mirrors)
+            except Exception as e:
+                logger.error(f"Error processing {kind} for {path}: {str(e)}")
+
+            for remote in self.remotes:
+                if kind == "rescan":
+                    remote.mark_dirty(src_root, path)
+                else:
+                    remote.put(src_root, path, operation)
+
+def verify_mirrors(sources: List[Path], mirrors: List[Path], trees: Dict[Path, MerkleTree],
+                   should_sync: Callable[[Path, Path], bool] = should_sync_files) -> None:
+    """Bring unwatched mirror-only folders back in line with the source folders.
+
+    Each mirror's tree is refreshed (a stat per file, rehashing only files
+    whose signature changed) and only the paths whose digests differ from
+    a source tree are synced, from whichever source has them. Paths no
+    source has are deleted, and a mirror's own copy never wins.
+    """
+    references = [trees[source] for source in sources if trees[source].ready]
+    if not references:
+        return
+
+    for mirror in mirrors:
+        tree = trees[mirror]
+        tree.build()
+        paths = sorted(set().union(*(reference.diff(tree) for reference in references)))
+        if paths:
+            logger.info(f"Mirror {mirror} differs in {len(paths)} path(s), resyncing")
+        for rel in paths:
+            src_root = next((source for source in sources if (source / rel).exists()), None)
+            if src_root is None:
+                sync_file_operation(sources[0] / rel, [mirror], "deleted", sources[0], trees,
+                                    should_sync)
+            elif (src_root / rel).is_dir():
+                rescan_subtree(src_root, src_root / rel, [mirror], trees, should_sync, [mirror])
+            else:
+                sync_file_operation(src_root / rel, [mirror], "modified", src_root, trees,
+                                    should_sync, [mirror])
+
+def _log_failure(future: "asyncio.Future", task: str) -> None:
+    """Log the error of a finished background task, which nothing else reads."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"{task} failed: {str(future.exception())}")
+
+def create_observer(options: Dict[str, Any], observers: List) -> Any:
+    """Return the observer that should watch a folder with the given options."""
+    if options.get("watch") == "poll":
+        observer = IncrementalPollingObserver(
+            interval=float(options.get("poll_interval", DEFAULT_POLL_INTERVAL)),
+            stat_budget=float(options.get("poll_stat_budget", DEFAULT_STAT_BUDGET))
+        )
+        observers.append(observer)
+        return observer
+    return observers[0]
+
+async def start_sync(folders: List[Path],
+                     folder_options: Optional[Dict[Path, Dict[str, Any]]] = None,
+                     group_name: str = "default",
+                     modes: Optional[Dict[Path, str]] = None,
+                     options: Optional[Dict[str, Any]] = None,
+                     remotes: Optional[List[Dict[str, Any]]] = None) -> None:
+    """Start the folder synchronization process.
+
+    Folders whose mode is mirror-only are not watched but verified every
+    ``verify_interval`` seconds; source-only folders are never written to.
+    Files are compared with the group's ``compare`` strategy. ``remotes``
+    are replica agents, brought up to date with the sources at startup and
+    then fed every change.
+    """
+    folder_options = folder_options or {}
+    modes = modes or {}
+    options = options or {}
+    sources = [folder for folder in folders if modes.get(folder) != "mirror-only"]
+    targets = [folder for folder in folders if modes.get(folder) != "source-only"]
+    mirrors = [folder for folder in folders if modes.get(folder) == "mirror-only"]
+    verify_interval = float(options.get("verify_interval", DEFAULT_VERIFY_INTERVAL))
+    strategy = options.get("compare", "paranoid")
+    mtime_tolerance = float(options.get("mtime_tolerance", DEFAULT_MTIME_TOLERANCE))
+    should_sync = make_comparator(strategy, mtime_tolerance)
+
+    observers = [Observer()]
+    trees = {folder: MerkleTree(folder) for folder in folders}
+    queue = PendingQueue(sources, name=group_name)
+    replicas = [RemoteReplica(remote["url"], sources, strategy, mtime_tolerance,
+                              remote["options"].get("token"), group_name,
+                              {source: trees[source] for source in sources})
+                for remote in remotes or []]
+    worker = SyncWorker(queue, targets, trees, should_sync, replicas, mirrors)
+    install_overflow_hook()
     
     try:
-        for folder in folders:
-            handler = FolderSyncHandler(folders, folder)
+        for replica in replicas:
+            for folder in sources:
+                replica.mark_dirty(folder)
+            replica.start()
+            logger.info(f"Replicating to agent: {replica.url}")
+
+        for folder in sources:
+            handler = FolderSyncHandler(queue, folder)
+            observer = create_observer(folder_options.get(folder, {}), observers)
             observer.schedule(handler, str(folder), recursive=True)
             logger.info(f"Started monitoring: {folder}")
             
-        observer.start()
+        worker.start()
+        # Starting sets up the native watches of whole trees, so keep it
+        # off the event loop shared with other groups
+        loop = asyncio.get_running_loop()
+        for observer in observers:
+            await loop.run_in_executor(None, observer.start)
         logger.info("Observer started")
+
+        # Build the replica indexes in the background; events arriving
+        # meanwhile are queued on each tree and applied once it is ready
+        verify = loop.run_in_executor(None, build_trees, trees)
+        verify.add_done_callback(lambda f: _log_failure(f, f"Index build for {group_name}"))
+        last_verify = float("-inf")
         
         while True:
             await asyncio.sleep(1)
+
+            if mirrors and sources and verify.done() and \
+                    time.monotonic() - last_verify >= verify_interval:
+                verify = loop.run_in_executor(None, verify_mirrors, sources, mirrors,
+                                              trees, should_sync)
+                verify.add_done_callback(
+                    lambda f: _log_failure(f, f"Mirror verification for {group_name}"))
+                last_verify = time.monotonic()
             
     except Exception as e:
         logger.error(f"Error in sync process: {str(e)}")
         raise
     finally:
-        observer.stop()
-        observer.join()
+        for observer in observers:
+            observer.stop()
+        for observer in observers:
+            if observer.is_alive():
+                observer.join()
+        queue.close()
+        if worker.is_alive():
+            worker.join()
+        for replica in replicas:
+            replica.close()
+        save_trees(trees)
         logger.info("Synchronization stopped") 
\ No newline at end of file
@@ -0,0 +1,171 @@
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACE_DIR = Path.home() / ".localsync" / "traces"
+DEFAULT_CAPACITY = 100000
+DEFAULT_PROFILE_RATE = 0.01
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter_ns() - self.start, self.args)
+        return False
+
+class Tracer:
+    """Span recorder for the sync pipeline, cheap enough to leave compiled in.
+
+    While disabled, ``span`` returns a shared no-op context manager. While
+    enabled, finished spans go into a ring buffer that ``dump`` writes in
+    Chrome trace-event format (load it in chrome://tracing or Perfetto).
+    With a ``profile_rate`` above zero, that fraction of work items also
+    runs under cProfile and the stats are accumulated for ``dump``.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.enabled = False
+        self.profile_rate = 0.0
+        self.dumps = 0
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._stats: Optional[pstats.Stats] = None
+        # perf_counter_ns has an arbitrary origin; anchor it to wall time
+        self._origin_ns = time.time_ns() - time.perf_counter_ns()
+
+    def enable(self, profile_rate: float = 0.0) -> None:
+        self.profile_rate = profile_rate
+        self.enabled = True
+        logger.info(f"Tracing enabled (profile rate {profile_rate})")
+
+    def disable(self) -> None:
+        self.enabled = False
+        logger.info("Tracing disabled")
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(self.profile_rate)
+
+    def span(self, name: str, **args):
+        """Context manager timing one pipeline stage."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name: str, start_ns: int, duration_ns: int, args: Dict[str, Any]) -> None:
+        # deque.append is atomic, no lock needed on the hot path
+        self._events.append((name, start_ns, duration_ns, threading.get_ident(), args))
+
+    @contextmanager
+    def profile(self):
+        """Run the block under cProfile for a sampled fraction of calls."""
+        if not self.enabled or not self.profile_rate or random.random() >= self.profile_rate:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # Another profiler is already active
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Buffered spans as a Chrome trace-event document."""
+        pid = os.getpid()
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (self._origin_ns + start_ns) / 1000,
+            'dur': duration_ns / 1000,
+            'pid': pid,
+            'tid': tid,
+            'args': {key: str(value) for key, value in args.items()}
+        } for name, start_ns, duration_ns, tid, args in list(self._events)]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, directory: Path = TRACE_DIR) -> Path:
+        """Write the trace, and the profile if any, returning the trace path."""
+        directory.mkdir(parents=True, exist_ok=True)
+        stem = f"trace-{datetime.now().strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        path = directory / f"{stem}.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+
+        with self._lock:
+            stats, self._stats = self._stats, None
+        if stats is not None:
+            stats.dump_stats(str(directory / f"{stem}.prof"))
+
+        self.dumps += 1
+        logger.info(f"Trace written to {path}")
+        return path
+
+    def clear(self) -> None:
+        self._events.clear()
+        with self._lock:
+            self._stats = None
+
+def install_signal_handlers() -> bool:
+    """Toggle tracing on SIGUSR1 and dump it on SIGUSR2.
+
+    Only possible from the main thread of a platform with these signals;
+    returns whether the handlers were installed.
+    """
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def dump(signum, frame):
+        try:
+            tracer.dump()
+        except OSError as e:
+            logger.error(f"Failed to write trace: {str(e)}")
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.toggle())
+    signal.signal(signal.SIGUSR2, dump)
+    return True
+
+# Global tracer shared by the whole process
+tracer = Tracer()
@@ -1,9 +1,23 @@
 import pytest
 from pathlib import Path
+from src.agent import (FRAME_PREFIX, AgentServer, RemoteReplica, parse_address, recv_frame,
+                       send_frame)
 from src.config_loader import load_config
-from src.file_handler import sync_file_operation
+from src.event_queue import PendingQueue, report_overflow
+from src.file_handler import (copy_file, get_file_hash, make_comparator, rescan_subtree,
+                              should_sync_files, sync_file_operation)
+from src.merkle import MerkleTree
+from src.polling import PollingSnapshot
+from src.supervisor import MAX_RESTART_DELAY, STABLE_PERIOD, Supervisor, shard_groups
+from src.sync_manager import create_observer, verify_mirrors
+from src.tracing import tracer
+import json
+import os
 import tempfile
 import shutil
+import socket
+import threading
+import time
 import yaml
 
 @pytest.fixture
@@ -23,4 +37,403 @@ def test_sync_file_creation(temp_folders):
     # Verify file exists in second folder
     synced_file = temp_folders[1] / "test.txt"
     assert synced_file.exists()
-    assert synced_file.read_text() == "test content" 
\ No newline at end of file
+    assert synced_file.read_text() == "test content" 
+
+def test_merkle_trees_track_synced_changes(temp_folders, monkeypatch):
+    (temp_folders[0] / "sub").mkdir()
+    (temp_folders[0] / "sub" / "a.txt").write_text("a")
+    (temp_folders[1] / "sub").mkdir()
+    (temp_folders[1] / "sub" / "a.txt").write_text("a")
+
+    trees = {folder: MerkleTree(folder) for folder in temp_folders}
+    for tree in trees.values():
+        tree.build()
+    assert trees[temp_folders[0]].digest == trees[temp_folders[1]].digest
+
+    test_file = temp_folders[0] / "sub" / "b.txt"
+    test_file.write_text("b")
+    trees[temp_folders[0]].update(Path("sub/b.txt"))
+    assert trees[temp_folders[0]].diff(trees[temp_folders[1]]) == ["sub/b.txt"]
+
+    # Events only stat the files; hashing waits until a digest is needed
+    hashed = []
+    monkeypatch.setattr("src.merkle.get_file_hash",
+                        lambda path: hashed.append(path) or get_file_hash(path))
+    sync_file_operation(test_file, temp_folders, "created", temp_folders[0], trees,
+                        make_comparator("quick"))
+    assert hashed == []
+    assert trees[temp_folders[0]].digest == trees[temp_folders[1]].digest
+    assert hashed == [temp_folders[1] / "sub" / "b.txt"]
+
+def test_merkle_tree_ignores_deleted_backups(temp_folders):
+    (temp_folders[0] / "a.txt").write_text("a")
+    (temp_folders[1] / "a.txt").write_text("a")
+    (temp_folders[1] / "old.txt.deleted.at20240101120000").write_text("old")
+
+    trees = [MerkleTree(folder) for folder in temp_folders]
+    for tree in trees:
+        tree.build()
+    assert trees[0].digest == trees[1].digest
+
+def test_load_config_folder_options(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump({
+        "folder_groups": {
+            "media": [
+                str(tmp_path / "local"),
+                {"path": str(tmp_path / "nas"), "watch": "poll", "poll_interval": 10},
+            ]
+        }
+    }))
+
+    groups = load_config(str(config_file))
+    nas = (tmp_path / "nas").resolve()
+    assert groups["media"]["folders"] == [(tmp_path / "local").resolve(), nas]
+    assert groups["media"]["folder_options"][nas] == {"watch": "poll", "poll_interval": 10}
+
+def test_polling_snapshot_detects_changes(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.txt").write_text("a")
+    snapshot = PollingSnapshot(tmp_path)
+    snapshot.build()
+    assert snapshot.step(len(snapshot)) == []
+
+    (tmp_path / "sub" / "a.txt").write_text("changed")
+    (tmp_path / "new").mkdir()
+    (tmp_path / "new" / "b.txt").write_text("b")
+    events = snapshot.step(len(snapshot))
+    events += snapshot.step(len(snapshot))
+
+    assert ("modified", str(tmp_path / "sub" / "a.txt"), False) in events
+    assert ("created", str(tmp_path / "new" / "b.txt"), False) in events
+
+def test_polling_snapshot_builds_in_slices(tmp_path):
+    for i in range(5):
+        (tmp_path / f"dir{i}").mkdir()
+        (tmp_path / f"dir{i}" / "a.txt").write_text("a")
+    snapshot = PollingSnapshot(tmp_path)
+    snapshot.reset()
+    steps = 0
+    while not snapshot.ready:
+        assert snapshot.step(2) == []
+        steps += 1
+    assert steps > 1 and len(snapshot) == 11
+
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump({
+        "folders": [{"path": str(tmp_path), "watch": "poll", "poll_stat_budget": 0}],
+    }))
+    with pytest.raises(RuntimeError):
+        load_config(str(config_file))
+
+    # Fractional budgets are kept rather than truncated to zero
+    observer = create_observer({"watch": "poll", "poll_stat_budget": 0.5}, [])
+    assert observer._emitter_class.keywords["stat_budget"] == 0.5
+
+def test_pending_queue_saturation_marks_subtree_dirty(tmp_path):
+    queue = PendingQueue([tmp_path], max_events=2)
+    queue.put(tmp_path, tmp_path / "a.txt", "created")
+    queue.put(tmp_path, tmp_path / "a.txt", "modified")
+    queue.put(tmp_path, tmp_path / "sub" / "b.txt", "created")
+    queue.put(tmp_path, tmp_path / "sub" / "c.txt", "created")
+    queue.put(tmp_path, tmp_path / "sub" / "d.txt", "created")
+
+    assert queue.get(0) == ("rescan", tmp_path, tmp_path / "sub", "modified")
+    assert queue.get(0) == ("event", tmp_path, tmp_path / "a.txt", "modified")
+    assert queue.get(0) is None
+
+def test_overflow_dirties_only_the_watching_queue(temp_folders):
+    watching = PendingQueue([temp_folders[0]])
+    other = PendingQueue([temp_folders[1]])
+    remote = PendingQueue([temp_folders[0]], watched=False)
+    watching.put(temp_folders[0], temp_folders[0] / "a.txt", "created")
+    watching.put(temp_folders[0], temp_folders[0] / "b.txt", "created")
+    watching.put(temp_folders[0], temp_folders[0] / "a.txt", "modified")
+    assert watching.get(0) == ("event", temp_folders[0], temp_folders[0] / "a.txt", "modified")
+
+    report_overflow(temp_folders[0])
+    assert watching.get(0) == ("rescan", temp_folders[0], temp_folders[0], "modified")
+    assert watching.get(0) is None
+    assert other.get(0) is None and remote.get(0) is None
+
+def test_rescan_subtree_syncs_missed_changes(temp_folders):
+    trees = {folder: MerkleTree(folder) for folder in temp_folders}
+    for folder in temp_folders:
+        (folder / "sub").mkdir()
+        (folder / "sub" / "old.txt").write_text("old")
+        trees[folder].build()
+
+    (temp_folders[0] / "sub" / "old.txt").unlink()
+    (temp_folders[0] / "sub" / "new.txt").write_text("new")
+    rescan_subtree(temp_folders[0], temp_folders[0] / "sub", temp_folders, trees)
+
+    assert (temp_folders[1] / "sub" / "new.txt").read_text() == "new"
+    assert not (temp_folders[1] / "sub" / "old.txt").exists()
+    assert trees[temp_folders[0]].digest == trees[temp_folders[1]].digest
+
+def test_group_options_select_worker_shards(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump({
+        "folder_groups": {name: [str(tmp_path / name)] for name in ("docs", "code", "media", "photos")},
+        "group_options": {"code": {"process": True}, "media": {"process": "hashing"},
+                          "photos": {"process": "hashing"}},
+    }))
+
+    local, shards = shard_groups(load_config(str(config_file)))
+    assert list(local) == ["docs"]
+    assert {shard: list(groups) for shard, groups in shards.items()} == {
+        "code": ["code"], "hashing": ["media", "photos"]}
+
+def test_supervisor_restarts_with_backoff():
+    class FakeProcess:
+        pid = 1234
+        exitcode = 1
+
+        def __init__(self, alive):
+            self.alive = alive
+
+        def is_alive(self):
+            return self.alive
+
+    supervisor = Supervisor({"docs": {}})
+    started = []
+    def start(shard):
+        supervisor._processes[shard] = FakeProcess(alive=True)
+        supervisor.health[shard].update(alive=True, last_heartbeat=time.time(),
+                                        started_at=time.time())
+        started.append(shard)
+    supervisor._start = start
+    health = supervisor.health["docs"]
+
+    for restarts in range(1, 10):
+        supervisor._processes["docs"] = FakeProcess(alive=False)
+        assert supervisor._check("docs")
+        assert health["restarts"] == restarts
+        delay = health["restart_at"] - time.time()
+        assert delay <= min(2 ** (restarts - 1), MAX_RESTART_DELAY)
+        assert not supervisor._check("docs")  # Still backing off
+        health["restart_at"] = 0.0
+        assert supervisor._check("docs") and len(started) == restarts
+    assert delay > MAX_RESTART_DELAY - 1
+
+    # Running stably for long enough forgets the earlier failures
+    assert not supervisor._check("docs")
+    health["started_at"] -= STABLE_PERIOD
+    assert supervisor._check("docs") and health["restarts"] == 0
+
+def test_supervisor_forwards_tracing_changes():
+    import queue
+    from src.supervisor import _follow_tracing
+
+    supervisor = Supervisor({"docs": {}})
+    control_queue = queue.Queue()
+    supervisor._controls["docs"] = control_queue
+    try:
+        tracer.enable()
+        supervisor._forward_tracing()
+        tracer.profile_rate = 0.5
+        supervisor._forward_tracing()
+        assert [control_queue.get_nowait() for _ in range(2)] == [
+            ("tracing", True, 0.0), ("tracing", True, 0.5)]
+
+        # The worker side applies them to its own tracer
+        tracer.disable()
+        tracer.profile_rate = 0.0
+        control_queue.put(("tracing", True, 0.25))
+        threading.Thread(target=_follow_tracing, args=(control_queue,), daemon=True).start()
+        deadline = time.time() + 5
+        while not tracer.enabled and time.time() < deadline:
+            time.sleep(0.01)
+        assert tracer.enabled and tracer.profile_rate == 0.25
+    finally:
+        tracer.disable()
+        tracer.profile_rate = 0.0
+
+def test_load_config_resolves_folder_modes(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump({
+        "folder_groups": {"docs": [str(tmp_path / "work"), str(tmp_path / "backup")]},
+        "group_options": {"docs": {"mode": "mirror-only"}},
+    }))
+    with pytest.raises(RuntimeError):
+        load_config(str(config_file))
+
+    config_file.write_text(yaml.safe_dump({
+        "folder_groups": {"docs": [
+            str(tmp_path / "work"),
+            {"path": str(tmp_path / "backup"), "mode": "mirror-only"},
+        ]},
+    }))
+    modes = load_config(str(config_file))["docs"]["modes"]
+    assert modes == {(tmp_path / "work").resolve(): "bidirectional",
+                     (tmp_path / "backup").resolve(): "mirror-only"}
+
+def test_verify_mirrors_resyncs_only_differences(temp_folders, tmp_path):
+    source, mirror = temp_folders
+    other = tmp_path / "other"
+    other.mkdir()
+    (source / "sub").mkdir()
+    (source / "sub" / "a.txt").write_text("a")
+    (source / "b.txt").write_text("source")
+    (mirror / "stale.txt").write_text("stale")
+    (mirror / "b.txt").write_text("edited in mirror")
+    (other / "only_in_other.txt").write_text("other")
+    (mirror / "only_in_other.txt").write_text("other")
+    mtime_ns = 1_700_000_000_000_000_000
+    os.utime(source / "b.txt", ns=(mtime_ns, mtime_ns))
+    trees = {folder: MerkleTree(folder) for folder in temp_folders + [other]}
+    for tree in trees.values():
+        tree.build()
+
+    verify_mirrors([source, other], [mirror], trees)
+
+    assert (mirror / "sub" / "a.txt").read_text() == "a"
+    assert not (mirror / "stale.txt").exists()
+    # A newer copy in the mirror does not win, a file of another source stays
+    assert (mirror / "b.txt").read_text() == "source"
+    assert (mirror / "only_in_other.txt").read_text() == "other"
+
+def test_compare_strategies(temp_folders):
+    src_file = temp_folders[0] / "test.txt"
+    target_file = temp_folders[1] / "test.txt"
+    src_file.write_text("new content")
+    target_file.write_text("old content")
+    mtime_ns = 1_700_000_000_000_000_000
+    os.utime(target_file, ns=(mtime_ns, mtime_ns))
+
+    # Same size and mtime: quick trusts the stat signature
+    os.utime(src_file, ns=(mtime_ns, mtime_ns))
+    assert not should_sync_files(src_file, target_file, "quick")
+    assert should_sync_files(src_file, target_file, "checksum-on-ambiguity")
+    assert should_sync_files(src_file, target_file, "paranoid")
+
+    # Identical content with a far newer source: only the hash notices
+    target_file.write_text("new content")
+    os.utime(target_file, ns=(mtime_ns, mtime_ns))
+    os.utime(src_file, ns=(mtime_ns + 10**10, mtime_ns + 10**10))
+    assert should_sync_files(src_file, target_file, "quick")
+    assert should_sync_files(src_file, target_file, "checksum-on-ambiguity")
+    assert not should_sync_files(src_file, target_file, "paranoid")
+
+def test_sparse_copy_preserves_holes_and_hash(temp_folders):
+    sparse_file = temp_folders[0] / "disk.img"
+    with open(sparse_file, "wb") as f:
+        f.truncate(64 * 1024 * 1024)
+        f.seek(10 * 1024 * 1024 + 123)
+        f.write(b"data" * 1000)
+        f.seek(64 * 1024 * 1024 - 4)
+        f.write(b"tail")
+    dense_file = temp_folders[1] / "dense.img"
+    dense_file.write_bytes(sparse_file.read_bytes())
+    assert get_file_hash(sparse_file) == get_file_hash(dense_file)
+
+    copied_file = temp_folders[1] / "disk.img"
+    copy_file(sparse_file, copied_file)
+    assert copied_file.read_bytes() == sparse_file.read_bytes()
+    assert get_file_hash(copied_file) == get_file_hash(sparse_file)
+    if hasattr(os.stat(sparse_file), "st_blocks") and os.stat(sparse_file).st_blocks * 512 < 1024 * 1024:
+        assert os.stat(copied_file).st_blocks * 512 < 1024 * 1024
+
+def test_tracing_records_pipeline_spans(temp_folders, tmp_path):
+    test_file = temp_folders[0] / "test.txt"
+    test_file.write_text("test content")
+
+    tracer.clear()
+    tracer.enable()
+    try:
+        sync_file_operation(test_file, temp_folders, "created", temp_folders[0])
+    finally:
+        tracer.disable()
+    sync_file_operation(test_file, temp_folders, "modified", temp_folders[0])
+
+    trace = json.loads(tracer.dump(tmp_path).read_text())
+    tracer.clear()
+    names = [event["name"] for event in trace["traceEvents"]]
+    assert names.count("target") == 1
+    assert {"is_file_in_use", "should_sync", "settle_delay", "copy_file"} <= set(names)
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in trace["traceEvents"])
+
+def test_remote_replica_over_loopback(temp_folders, tmp_path, monkeypatch):
+    source, replica = temp_folders
+    for i in range(300):
+        (source / f"dir{i % 3}").mkdir(exist_ok=True)
+        (source / f"dir{i % 3}" / f"{i}.txt").write_text(f"file {i}")
+    with open(source / "disk.img", "wb") as f:
+        f.write(b"x" * 3 * 1024 * 1024)
+        f.truncate(32 * 1024 * 1024)
+
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump({
+        "folders": [str(source), {"path": "agent://127.0.0.1:0", "token": "secret"}],
+    }))
+    group = load_config(str(config_file))["default"]
+    assert group["folders"] == [source.resolve()]
+    assert group["remotes"] == [{"url": "agent://127.0.0.1:0", "options": {"token": "secret"}}]
+
+    server = AgentServer(replica, "127.0.0.1:0", token="secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tree = MerkleTree(source)
+    tree.build()
+    remote = RemoteReplica(server.address, [source], token="secret", trees={source: tree})
+    try:
+        remote.sync_batch([("rescan", source, source, "modified")])
+        assert (replica / "dir1" / "1.txt").read_text() == "file 1"
+        assert get_file_hash(replica / "disk.img") == get_file_hash(source / "disk.img")
+        # Metadata and small files are batched, not sent one request each
+        assert remote._next_id < 30
+
+        requests = remote._next_id
+        server.index.build()
+        hashed = []
+        monkeypatch.setattr("src.merkle.get_file_hash",
+                            lambda path: hashed.append(path) or get_file_hash(path))
+        remote.sync_batch([("rescan", source, source, "modified")])
+        # One stat and one hash round-trip, and listing the agent's two levels
+        assert remote._next_id - requests == 4
+        # Both sides answer the hashes from their index
+        assert hashed == []
+        monkeypatch.undo()
+
+        (source / "dir0" / "0.txt").unlink()
+        remote.sync_batch([("event", source, source / "dir0" / "0.txt", "deleted")])
+        assert not (replica / "dir0" / "0.txt").exists()
+        assert any(path.name.startswith("0.txt.deleted.at") for path in (replica / "dir0").iterdir())
+
+        # Rescans remove what no source has, without an event for it
+        (replica / "dir2" / "stale.txt").write_text("stale")
+        (replica / "gone").mkdir()
+        remote.sync_batch([("rescan", source, source, "modified")])
+        assert not (replica / "dir2" / "stale.txt").exists()
+        assert not (replica / "gone").exists()
+
+        # A deletion survives a failed batch
+        server.shutdown()
+        remote._disconnect()
+        (source / "dir1" / "1.txt").unlink()
+        remote.put(source, source / "dir1" / "1.txt", "deleted")
+        remote.start()
+        deadline = time.time() + 10
+        while remote.queue.snapshot()['queued'] < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert remote.queue.snapshot()['queued'] == 2  # Put back after the failure
+        server = AgentServer(replica, remote.url[len("agent://"):], token="secret")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        while (replica / "dir1" / "1.txt").exists() and time.time() < deadline:
+            time.sleep(0.05)
+        assert not (replica / "dir1" / "1.txt").exists()
+
+        intruder = RemoteReplica(server.address, [source], token="wrong")
+        with pytest.raises(RuntimeError):
+            intruder.sync_batch([("event", source, source / "dir2" / "2.txt", "modified")])
+
+        # Unauthenticated clients get a plain refusal and only a small hello is read
+        _, address = parse_address(server.address)
+        with socket.create_connection(address) as sock:
+            send_frame(sock, {"op": "hello", "token": 1})
+            assert recv_frame(sock)[0]["ok"] is False
+        with socket.create_connection(address) as sock:
+            sock.sendall(FRAME_PREFIX.pack(1024 * 1024, 0))
+            assert recv_frame(sock) is None
+    finally:
+        remote.close()
+        server.shutdown()